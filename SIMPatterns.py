@@ -1,6 +1,7 @@
 """ slm.py - python module to control spatial light modulator """
 
 import numpy
+import kernels
 from numpy import arange, array, meshgrid, cos, sin, deg2rad, pi
 # import matplotlib.pyplot as plt
 
@@ -13,33 +14,44 @@ class SIMPattern3D():
         self.wavelength = 532
         self.theta = 1
         self.phase_then_angle = True
+        ## Retardation to balance m=0,+/-1 orders, in 16-bit units;
+        # the same as used by slmservice.
+        self.modulation = 65535 * 150. / 360.
 
-        self.patterns = []
-        for i in range(0, len(self.angles) * len(self.phases)):
-            self.patterns.append(numpy.zeros((self.pixels, self.pixels)))
+        ## Index grids, broadcastable against (row, column).
+        # Evaluated once, on first use.
+        self._grids = None
+        ## Pattern stack: one frame per angle/phase combination.
+        self.patterns = numpy.zeros(
+            (len(self.angles) * len(self.phases), self.pixels, self.pixels),
+            dtype=numpy.uint16)
+
+
+    def _get_grids(self):
+        """ Return cached (k, l) column and row index grids. """
+        if self._grids is None or self._grids[0].shape[-1] != self.pixels:
+            indices = arange(self.pixels, dtype=numpy.float64)
+            self._grids = (indices[numpy.newaxis, :],
+                           indices[:, numpy.newaxis])
+        return self._grids
 
 
     def update_patterns(self, angle_offset=None, wavelength=None,
                         theta=None, phase_then_angle=None):
+        """ Evaluate all patterns; return them as an (N, pixels, pixels) array.
 
-        ## The pattern-generating function --- defined here so it may
-        # be used in either phase- or angle-first loops, later.
-        def patternfunc(k, l, theta_rad, mp2):
-            return numpy.round(
-                mp2 * 2 / (2 * pi) *
-                (
-                    127.5 + 127.5 *
-                    cos((2 * pi * (cos(theta_rad) * k + sin(theta_rad) * l)) /
-                    pp + deg2rad(phase)
-                )))
-
+        With phase_then_angle, the phase varies fastest, i.e. frames are
+        ordered (a0 p0, a0 p1, ... a1 p0 ...); otherwise the angle varies
+        fastest. Frames are 16-bit and can be passed straight to
+        set_custom_sequence.
+        """
         ## Pattern ordering, angles and phases.
-        phase_then_angle = phase_then_angle or self.phase_then_angle
-        phases = self.phases
-        if angle_offset     is not None:
-            angles = self.angles + angle_offset
-        else:
-            angles = self.angles
+        if phase_then_angle is None:
+            phase_then_angle = self.phase_then_angle
+        phases = array(self.phases, dtype=numpy.float64)
+        angles = array(self.angles, dtype=numpy.float64)
+        if angle_offset is not None:
+            angles = angles + angle_offset
 
         ## Optical parameters - desired diffraction angle and incident
         # wavelength.
@@ -53,24 +65,23 @@ class SIMPattern3D():
             wavelength *= 1e-9
         pp = wavelength / (self.pixel_pitch * sin(deg2rad(theta)))
 
-        ## Scaling factor to balance m=0,+/-1 orders
-        mp2 = 1000*3.14159
-
-        ## Iterator over self.patterns
-        i = 0
-
-        indices = arange(self.pixels)
-        k, l = meshgrid(indices, indices)
-
+        ## Angle and phase for each frame, in output order.
         if phase_then_angle:
-            for angle in angles:
-                for phase in phases:
-                    self.patterns[i] = patternfunc(k, l, deg2rad(angle), mp2)
-                    i += 1
+            frame_angles = numpy.repeat(angles, len(phases))
+            frame_phases = numpy.tile(phases, len(angles))
         else:
-            for phase in phases:
-                for angle in angles:
-                    self.patterns[i] = patternfunc(k, l, deg2rad(angle), mp2)
-                    i += 1
-        print self.patterns[i].min
-        print self.patterns[i].max
+            frame_angles = numpy.tile(angles, len(phases))
+            frame_phases = numpy.repeat(phases, len(angles))
+        theta_rad = deg2rad(frame_angles)[:, numpy.newaxis, numpy.newaxis]
+        phase_rad = deg2rad(frame_phases)[:, numpy.newaxis, numpy.newaxis]
+
+        ## Evaluate every frame in one pass with the selected kernel
+        # backend: per-frame parameters broadcast against the grids.
+        k, l = self._get_grids()
+        shape = (len(frame_angles), self.pixels, self.pixels)
+        if self.patterns.shape != shape:
+            self.patterns = numpy.empty(shape, dtype=numpy.uint16)
+        kernels.grating(k, l, cos(theta_rad), sin(theta_rad), pp, phase_rad,
+                        0.5 * self.modulation, 0.5 * self.modulation,
+                        out=self.patterns)
+        return self.patterns
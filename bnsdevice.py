@@ -18,8 +18,11 @@ limitations under the License.
 import ctypes
 import os, sys
 import numpy as np
-from ctypes import c_int, c_bool, c_double, c_short
-from ctypes import c_char, c_char_p, c_uint, c_ushort, windll
+import bnsinterface
+import bnstrace
+from bnsinterface import CELSIUS, NEMATIC
+from multiprocessing.pool import ThreadPool
+from timeit import default_timer as timer
 
 CLASS_NAME = "BNSDevice"
 
@@ -47,22 +50,30 @@ class BNSDevice(object):
     + void SLMPower (int Board, bool PowerOn)
     + void WriteCal (int Board, CAL_TYPE Caltype={WFC;NUC},
                      unsigned char* Image)
-      int ComputeTF (float FrameRate)
+    + int ComputeTF (float FrameRate)
     + void SetTrueFrames (int Board, int TrueFrames)
     
     ==== Undocumented ====
-    + GetInternalTemp
-      GetTIFFInfo
-    + GetCurSeqImage
-      GetImageSize
+    + double GetInternalTemp (int Board, TEMPUNITS units)
+      void GetTIFFInfo (const char* FilePath, unsigned int* Width,
+                        unsigned int* Height, unsigned short* BPP)
+    + int GetCurSeqImage (int Board)
+    o int GetImageSize (int Board)
     
     ==== Notes ====
     The BNS documentation states that int Board is a 1-based index, but it
     would appear to be 0-based:  if I address board 1 with Board=1, I get an msc
     error; using Board=0 seems to work just fine.
+
+    Prototypes for all of these are declared in bnsinterface, so calls take
+    plain python values, and ndarrays for image buffers.
+
+    Constructor opens every board at once, so with several boards only one
+    instance should call initialize; use open_boards to get an instance per
+    board sharing the one library.
     """
 
-    def __init__(self):
+    def __init__(self, board=0, lib=None):
         # Must chdir to module path or DLL can not find its dependencies.
         try:
             modpath = os.path.dirname(__file__)
@@ -72,14 +83,36 @@ class BNSDevice(object):
             modpath = ''
         # path to dll
         self.libPath = os.path.join(modpath, "PCIe16Interface")
+        # The board index passed to every board-specific DLL call.
+        self.board = board
+        # Whether we loaded the library ourselves, and so may reload it.
+        self.ownsLib = lib is None
         # loaded library instance
         # Now loaded here so that read_tiff is accessible even if there is no 
-        # SLM present.
-        self.lib = ctypes.WinDLL(self.libPath)
+        # SLM present. A library passed in may be shared with other
+        # instances, or be a simulation.
+        if lib is None:
+            self.lib = bnsinterface.load(self.libPath)
+        else:
+            self.lib = bnsinterface.wrap(lib)
         # Boolean showing initialization status.
         self.haveSLM = False
+        # Whether this instance called Constructor.
+        self.constructed = False
+        # Number of boards reported by Constructor.
+        self.numBoards = 0
+        # Devices sharing this library, including this one.
+        self.peers = [self]
         # Data type to store images.
         self.imagetype = None
+        # TraceRecorder for DLL calls, if tracing.
+        self.tracer = None
+        ## Last settings sent to the board, replayed by restore.
+        # LUT file, calibration buffers by CAL_TYPE, true frames, frame
+        # rate, sequence buffer, power and whether sequencing.
+        self.state = {'lut': None, 'cal': {}, 'trueFrames': None,
+                      'frameRate': None, 'sequence': None, 'power': None,
+                      'running': False}
 
     ## === DECORATORS === #
     # decorator definition for methods that require an SLM      
@@ -95,67 +128,170 @@ class BNSDevice(object):
     @property
     @requires_slm
     def curr_seq_image(self): # tested - works
-        return self.lib.GetCurSeqImage(c_int(0))
+        return self.lib.GetCurSeqImage(self.board)
 
 
     @property
     @requires_slm
     def power(self): #tested - works
-        return self.lib.GetSLMPower(c_int(0))
+        return self.lib.GetSLMPower(self.board)
     @power.setter
     @requires_slm
     def power(self, value): #tested - works
-        self.lib.SLMPower(c_int(0), c_bool(value))
+        self.lib.SLMPower(self.board, value)
+        self.state['power'] = bool(value)
 
 
     @property
     @requires_slm
     def temperature(self): #tested - works
-        return self.lib.GetInternalTemp(c_int(0))
+        ## double GetInternalTemp (int Board, TEMPUNITS units)
+        return self.lib.GetInternalTemp(self.board, CELSIUS)
 
 
     ## === METHODS === #
 
     ## Don't call this unless an SLM was initialised:  if you do, the next call
     # can open a dialog box from some other library down the chain.
+    # Deconstructor closes every board, so instances that were attached to
+    # a library constructed elsewhere just mark themselves uninitialized.
     @requires_slm
     def cleanup(self): #tested
-        try:
-            self.lib.Deconstructor()
-        except:
-            pass
+        if self.constructed:
+            try:
+                self.lib.Deconstructor()
+            except:
+                pass
+            self.constructed = False
         self.haveSLM = False
 
 
+    def as_buffer(self, image):
+        """ Return image as a contiguous uint16 array to pass to the DLL.
+
+        Arrays that are already contiguous uint16 are passed without a copy.
+        """
+        if isinstance(image, ctypes.Array):
+            return image
+        data = np.ascontiguousarray(image, dtype=np.uint16)
+        if data.size != self.size * self.size:
+            raise Exception('Unable to convert image: expected %d pixels, '\
+                            'got %d.' % (self.size * self.size, data.size))
+        return data
+
+
+    def attach(self):
+        """ Start using our board on a library that is already constructed. """
+        self.haveSLM = True
+        self.size = self.lib.GetImageSize(self.board)
+        self.imagetype = bnsdatatype * (self.size * self.size)
+        # SLM shows nothing without calibration, so set flat WFC.
+        white = self.imagetype(65535)
+        self.write_cal(bnsinterface.WFC, white)
+
+
+    @requires_slm
+    def compute_true_frames(self, frameRate):
+        ## int ComputeTF (float FrameRate)
+        # Number of true frames needed to display images at frameRate.
+        return self.lib.ComputeTF(frameRate)
+
+
     def initialize(self): #tested
         ## Need to unload and reload the DLL here.
         # Otherwise, the DLL can open an error window about having already
         # initialized another DLL, which we won't see on a remote machine.
-        if self.lib:
-            while(windll.kernel32.FreeLibrary(self.lib._handle)):
+        if self.lib and self.ownsLib:
+            while(ctypes.windll.kernel32.FreeLibrary(self.lib._handle)):
                 # Keep calling FreeLibrary until library is really closed.
                 pass
-        try:      
-            # re-open the DLL
-            self.lib = ctypes.WinDLL(self.libPath)
-        except:
-            raise
+            try:
+                # re-open the DLL
+                self.lib = bnsinterface.load(self.libPath)
+            except:
+                raise
+            if self.tracer:
+                self.lib = bnstrace.TracingLibrary(self.lib, self.tracer)
         
         # Initlialize the library, looking for nematic SLMs.
-        n = self.lib.Constructor(c_int(1)) 
+        n = self.lib.Constructor(NEMATIC)
+        self.numBoards = n
         if n == 0:
             raise Exception("No SLM device found.")
-        elif n > 1:
-            raise Exception("More than one SLM device found. This module "\
-                            "can only handle one device.")
-        else:
-            self.haveSLM = True
-            self.size = self.lib.GetImageSize(0)
-            self.imagetype = bnsdatatype * (self.size * self.size)
-        # SLM shows nothing without calibration, so set flat WFC.
-        white = self.imagetype(65535)
-        self.write_cal(1, white)
-
+        elif self.board >= n:
+            raise Exception("Board %d requested, but only %d SLM device(s) "\
+                            "found." % (self.board, n))
+        self.constructed = True
+        self.attach()
+
+
+
+    def reconnect(self):
+        """ Re-open the boards and restore their last known state.
+
+        Unlike initialize, the DLL stays loaded, and settings are replayed
+        from buffers that are already converted; see restore. Deconstructor
+        and Constructor reset every board on the library, so they are
+        called once, and every device in peers is restored. Calls for the
+        other boards must not be made meanwhile. Returns the time taken in
+        s, and a dict of the time taken by each board's sequence upload.
+        """
+        t0 = timer()
+        # The device that constructed the library, if any, owns it.
+        owners = [device for device in self.peers if device.constructed]
+        owner = (owners or [self])[0]
+        if owners:
+            try:
+                self.lib.Deconstructor()
+            except:
+                pass
+            owner.constructed = False
+        for device in self.peers:
+            device.haveSLM = False
+        n = self.lib.Constructor(NEMATIC)
+        owner.constructed = True
+        for device in self.peers:
+            device.numBoards = n
+            if device.board >= n:
+                raise Exception("Board %d requested, but only %d SLM "\
+                                "device(s) found." % (device.board, n))
+        uploadTimes = {}
+        for device in self.peers:
+            uploadTimes[device.board] = device.restore()[1]
+        return timer() - t0, uploadTimes
+
+
+    def restore(self):
+        """ Replay the last known settings to a re-opened board.
+
+        Restores the calibration, LUT, true frames, frame rate, sequence,
+        power and sequencing, as last set. Returns the time taken, and that
+        taken by the sequence upload, in s.
+        """
+        t0 = timer()
+        state = self.state
+        self.haveSLM = True
+        self.size = self.lib.GetImageSize(self.board)
+        self.imagetype = bnsdatatype * (self.size * self.size)
+        for type, image in state['cal'].items():
+            self.lib.WriteCal(self.board, type, image)
+        if state['lut'] is not None:
+            self.lib.LoadLUTFile(self.board, state['lut'])
+        if state['trueFrames'] is not None:
+            self.lib.SetTrueFrames(self.board, state['trueFrames'])
+        if state['frameRate'] is not None:
+            self.lib.SetSequencingRate(state['frameRate'])
+        upload_time = 0.
+        sequence = state['sequence']
+        if sequence is not None:
+            t1 = timer()
+            self.lib.LoadSequence(self.board, sequence, len(sequence))
+            upload_time = timer() - t1
+        if state['power'] is not None:
+            self.lib.SLMPower(self.board, state['power'])
+        if state['running']:
+            self.lib.StartSequence()
+        return timer() - t0, upload_time
 
 
     @requires_slm
@@ -163,66 +299,129 @@ class BNSDevice(object):
         ## Warning: opens a dialog if it can't read the LUT file.
         # Should probably check if the LUT file exists and validate it
         # before calling LoadLUTFile.
-        self.lib.LoadLUTFile(c_int(0), c_char_p(filename))
+        self.lib.LoadLUTFile(self.board, filename)
+        self.state['lut'] = filename
 
 
     @requires_slm
     def load_sequence(self, imageList): #tested - no errors
-        # imageList is a list of images, each of which is a list of integers.
-        if len(imageList) < 2:
+        # imageList is an iterable of images, each of which is an array or
+        # list of integers.
+        self.load_sequence_buffer(self.make_sequence_buffer(imageList))
+
+
+    def new_sequence_buffer(self, count):
+        """ Return an empty array of count images for load_sequence_buffer.
+
+        Returns (sequence, frames): frames is a (count, size, size) ndarray
+        view of sequence, through which images can be written in place.
+        """
+        sequence = (self.imagetype * count)()
+        frames = np.frombuffer(sequence, dtype=np.uint16)
+        return sequence, frames.reshape((count, self.size, self.size))
+
+
+    def make_sequence_buffer(self, imageList, count=None):
+        """ Return images as a contiguous array for load_sequence_buffer.
+
+        imageList may be any iterable, e.g. a generator: images are copied
+        one at a time straight into the array. count is needed if it has
+        no len().
+        """
+        if count is None:
+            if not hasattr(imageList, '__len__'):
+                imageList = list(imageList)
+            count = len(imageList)
+        sequence, frames = self.new_sequence_buffer(count)
+        n = 0
+        for image in imageList:
+            if n == count:
+                raise Exception('More than %d images.' % count)
+            data = np.asarray(image, dtype=np.uint16)
+            if data.size != self.size * self.size:
+                raise Exception('Unable to convert image: expected %d '\
+                                'pixels, got %d.' 
+                                % (self.size * self.size, data.size))
+            frames[n] = data.reshape((self.size, self.size))
+            n += 1
+        if n != count:
+            raise Exception('Expected %d images, got %d.' % (count, n))
+        return sequence
+
+
+    @requires_slm
+    def load_sequence_buffer(self, sequence):
+        """ Load a sequence prepared by make_sequence_buffer. """
+        if len(sequence) < 2:
             raise Exception("load_sequence expects a list of two or more "\
                             "images - it was passed %s images." 
-                            % len(imageList))
-
-        if all([type(image) is self.imagetype for image in imageList]):
-            # Data is fine as it is.
-            pass            
-        else:
-            # Some images need converting.
-            flatImages = []
-            for image in imageList:
-                if type(image) is np.ndarray:
-                    flatImages.append(self.imagetype(*image.flatten()))
-                else:
-                    flatImages.append(self.imagetype(*image))
-            imageList = flatImages
-
-        # Make a contiguous array.
-        sequence = (self.imagetype * len(imageList))(*imageList)
+                            % len(sequence))
         # LoadSequence (int Board, unsigned short* Image, int NumberOfImages)
-        self.lib.LoadSequence(c_int(0), ctypes.byref(sequence), 
-                              c_int(len(imageList)))
+        self.lib.LoadSequence(self.board, sequence, len(sequence))
+        # Kept, as it is, to restore the board.
+        self.state['sequence'] = sequence
 
 
     def read_tiff(self, filePath):
         ## void ReadTIFF (const char* FilePath, unsigned short* ImageData,
         #                unsigned int ScaleWidth, unsigned int ScaleHeight) 
         buffer = self.imagetype()
-        self.lib.ReadTIFF(c_char_p(filePath), buffer, 
-                          self.size, self.size)
+        self.lib.ReadTIFF(filePath, buffer, self.size, self.size)
         return buffer
 
 
+    def start_trace(self, path):
+        """ Record every subsequent DLL call to a trace file at path.
+
+        path may instead be a TraceRecorder, to share one trace file
+        between devices.
+        """
+        self.stop_trace()
+        if isinstance(path, bnstrace.TraceRecorder):
+            self.tracer = path.acquire()
+        else:
+            self.tracer = bnstrace.TraceRecorder(path).acquire()
+        self.lib = bnstrace.TracingLibrary(self.lib, self.tracer)
+        return self.tracer
+
+
+    def stop_trace(self):
+        """ Stop recording DLL calls.
+
+        The trace file is closed once no other device is recording to it.
+        """
+        if self.tracer is None:
+            return
+        if isinstance(self.lib, bnstrace.TracingLibrary):
+            self.lib = self.lib.lib
+        self.tracer.release()
+        self.tracer = None
+
+
     @requires_slm
     def set_sequencing_framrate(self, frameRate): # tested - no errors
         ## Note - probably requires internal-triggering DLL,
         # rather than that set up for external triggering.
-        self.lib.SetSequencingRate( c_double(frameRate) )
+        self.lib.SetSequencingRate(frameRate)
+        self.state['frameRate'] = frameRate
 
 
     @requires_slm
     def set_true_frames(self, trueFrames): #tested - no errors
-        self.lib.SetTrueFrames(c_int(0), c_int(trueFrames))
+        self.lib.SetTrueFrames(self.board, trueFrames)
+        self.state['trueFrames'] = trueFrames
 
 
     @requires_slm
     def start_sequence(self): # tested - works
         self.lib.StartSequence()
+        self.state['running'] = True
 
 
     @requires_slm
     def stop_sequence(self): # tested - works
         self.lib.StopSequence()
+        self.state['running'] = False
 
 
     @requires_slm
@@ -241,17 +440,89 @@ class BNSDevice(object):
         # the calibration files are 16-bit.
         # Header file states it's an unsigned short.
         
-        image = self.imagetype(*calImage)
-        self.lib.WriteCal(c_int(0), c_int(type), ctypes.byref(image))
+        image = self.as_buffer(calImage)
+        self.lib.WriteCal(self.board, type, image)
+        # A copy, in case the caller's array changes.
+        self.state['cal'][type] = np.array(image, dtype=np.uint16)
 
 
     @requires_slm
     def write_image(self, image): #tested - works
     ## void WriteImage (int Board, unsigned short* Image)
-        if type(image) is self.imagetype:
-            self.lib.WriteImage(c_int(0), 
-                                ctypes.byref(self.imagetype(*image)))
-        elif type(image) is np.ndarray:
-            self.lib.WriteImage(0, self.imagetype(*image.flatten()))
-        else:
-            raise Exception('Unable to convert image.')
+        self.lib.WriteImage(self.board, self.as_buffer(image))
+
+
+
+def open_boards(lib=None):
+    """ Initialize the library and return a BNSDevice for every board.
+
+    The devices share one library; the first owns it, and its cleanup
+    closes all boards.
+    """
+    first = BNSDevice(0, lib)
+    first.initialize()
+    devices = [first]
+    for board in range(1, first.numBoards):
+        device = BNSDevice(board, first.lib)
+        device.attach()
+        devices.append(device)
+    # Shared, so that reconnect restores every board.
+    for device in devices:
+        device.peers = devices
+    return devices
+
+
+class BoardGroup(object):
+    """ Dispatches calls for different boards concurrently on a thread pool.
+
+    The DLL releases the GIL for the duration of each call, so uploads to
+    different boards overlap. Calls for any one board should not be
+    dispatched concurrently.
+    """
+    def __init__(self, members, threads=None):
+        # members maps board index to an object addressing that board.
+        self.members = dict(members)
+        self.pool = ThreadPool(threads or len(self.members))
+
+
+    def dispatch(self, method, argsByBoard):
+        """ Call method on each board with its own args, concurrently.
+
+        argsByBoard maps board index to a tuple of arguments.
+        Returns a dict mapping board index to result; if any call raises,
+        the first exception is re-raised once all calls have finished.
+        """
+        boards = list(argsByBoard)
+        for board in boards:
+            if board not in self.members:
+                raise Exception("No board with index %s." % board)
+
+        def call(board):
+            func = getattr(self.members[board], method)
+            return func(*argsByBoard[board])
+
+        results = self.pool.map(call, boards)
+        return dict(zip(boards, results))
+
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+    def load_sequence(self, imageListsByBoard):
+        return self.dispatch('load_sequence', 
+                             {b: (images,) for b, images 
+                                           in imageListsByBoard.items()})
+
+
+    def write_cal(self, type, calImagesByBoard):
+        return self.dispatch('write_cal',
+                             {b: (type, image) for b, image 
+                                               in calImagesByBoard.items()})
+
+
+    def write_image(self, imagesByBoard):
+        return self.dispatch('write_image',
+                             {b: (image,) for b, image 
+                                          in imagesByBoard.items()})
@@ -0,0 +1,148 @@
+""" Typed bindings for the functions in PCIe16Interface.h.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+PROTOTYPES declares each function once, as in the header, so that ctypes
+converts arguments and results itself: callers pass plain python values,
+and image arguments may be uint16 ndarrays, ctypes arrays or byref()s,
+without copies. load() binds the prototypes to the DLL; wrap() gives a
+python implementation, e.g. bnssim.SimulatedLibrary, the same interface,
+so that calls that break the header's contract fail in simulation too.
+"""
+
+import ctypes
+import numpy
+from collections import OrderedDict
+from ctypes import c_bool, c_char_p, c_double, c_float, c_int
+from ctypes import c_uint, c_ushort, POINTER
+
+## enum LC_TYPE
+FERROELECTRIC = 0
+NEMATIC = 1
+## enum CAL_TYPE
+NUC = 0
+WFC = 1
+## enum TEMPUNITS
+CELSIUS = 0
+FAHRENHEIT = 1
+
+## Enums are passed as int.
+LC_TYPE = CAL_TYPE = TEMPUNITS = c_int
+
+
+class ImageBuffer(object):
+    """ Argument type for unsigned short* image buffers.
+
+    Accepts C-contiguous uint16 ndarrays, which are passed without a copy,
+    as well as ctypes arrays and byref()s.
+    """
+    pointer = POINTER(c_ushort)
+
+    @classmethod
+    def from_param(cls, obj):
+        if isinstance(obj, numpy.ndarray):
+            if obj.dtype != numpy.uint16 or not obj.flags.c_contiguous:
+                raise TypeError("Image buffers must be C-contiguous uint16, "
+                                "not %s." % obj.dtype)
+            return obj.ctypes.data_as(cls.pointer)
+        # ctypes arrays, pointers and byref()s.
+        return obj
+
+
+## Function name: (restype, argtypes), in the order of PCIe16Interface.h.
+PROTOTYPES = OrderedDict([
+    ('Constructor', (c_int, (LC_TYPE,))),
+    ('Deconstructor', (None, ())),
+    ('ReadTIFF', (None, (c_char_p, ImageBuffer, c_uint, c_uint))),
+    ('GetTIFFInfo', (None, (c_char_p, POINTER(c_uint), POINTER(c_uint),
+                            POINTER(c_ushort)))),
+    ('WriteImage', (None, (c_int, ImageBuffer))),
+    ('LoadSequence', (None, (c_int, ImageBuffer, c_int))),
+    ('SetSequencingRate', (None, (c_double,))),
+    ('StartSequence', (None, ())),
+    ('GetCurSeqImage', (c_int, (c_int,))),
+    ('StopSequence', (None, ())),
+    ('GetImageSize', (c_int, (c_int,))),
+    ('GetSLMPower', (c_bool, (c_int,))),
+    ('SLMPower', (None, (c_int, c_bool))),
+    ('WriteCal', (None, (c_int, CAL_TYPE, ImageBuffer))),
+    ('LoadLUTFile', (None, (c_int, c_char_p))),
+    ('ComputeTF', (c_int, (c_float,))),
+    ('SetTrueFrames', (None, (c_int, c_int))),
+    ('GetInternalTemp', (c_double, (c_int, TEMPUNITS))),
+    ])
+
+
+def bind(lib):
+    """ Declare the prototypes on the functions of a loaded DLL. """
+    for name, (restype, argtypes) in PROTOTYPES.items():
+        func = getattr(lib, name)
+        func.restype = restype
+        func.argtypes = argtypes
+    return lib
+
+
+def load(path):
+    """ Load and bind the DLL at path. """
+    return bind(ctypes.WinDLL(path))
+
+
+def _convert(argtype, arg):
+    """ Convert arg as ctypes would for argtype, for a python callee. """
+    if argtype is ImageBuffer or hasattr(argtype, 'contents'):
+        # Buffers and pointers are passed on, once checked.
+        argtype.from_param(arg)
+        return arg
+    if isinstance(arg, argtype):
+        return arg.value
+    return argtype(arg).value
+
+
+class TypedLibrary(object):
+    """ Gives a python implementation of the DLL the DLL's prototypes.
+
+    Arguments are checked and converted as ctypes would for the DLL, e.g.
+    to float precision for ComputeTF, and results converted to restype.
+    """
+    def __init__(self, lib):
+        self.lib = lib
+
+
+    def __getattr__(self, name):
+        attr = getattr(self.lib, name)
+        if name not in PROTOTYPES:
+            return attr
+        restype, argtypes = PROTOTYPES[name]
+        def call(*args):
+            if len(args) != len(argtypes):
+                raise TypeError("%s takes %d arguments (%d given)"
+                                % (name, len(argtypes), len(args)))
+            result = attr(*[_convert(argtype, arg)
+                            for argtype, arg in zip(argtypes, args)])
+            if restype is None:
+                return None
+            return restype(result).value
+        # Cache the wrapper so __getattr__ is only hit once per function.
+        setattr(self, name, call)
+        return call
+
+
+def wrap(lib):
+    """ Return lib, bound to or wrapped in the prototypes if it isn't yet. """
+    if isinstance(lib, ctypes.CDLL):
+        return bind(lib)
+    if isinstance(lib, TypedLibrary):
+        return lib
+    return TypedLibrary(lib)
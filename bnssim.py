@@ -0,0 +1,186 @@
+""" Simulation of the BNS PCIe16Interface DLL, for use without hardware.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import ctypes
+import threading
+import numpy
+from time import sleep
+from timeit import default_timer as timer
+
+
+def _value(arg):
+    """ Unwrap a ctypes argument to a python value or buffer object. """
+    if hasattr(arg, '_obj'):
+        # Returned by ctypes.byref.
+        return arg._obj
+    if isinstance(arg, ctypes._SimpleCData):
+        return arg.value
+    return arg
+
+
+def _as_array(buf):
+    """ Return a flat uint16 ndarray copy of a ctypes or numpy buffer. """
+    return numpy.frombuffer(buf, dtype=numpy.uint16).copy()
+
+
+class SimulatedBoard(object):
+    """ State held by the DLL for one board. """
+    def __init__(self, size):
+        self.size = size
+        self.power = False
+        self.lut = None
+        self.cal = {}
+        self.image = None
+        self.sequence = None
+        self.numImages = 0
+        self.trueFrames = None
+
+
+class SimulatedLibrary(object):
+    """ Implements the functions exported by PCIe16Interface.DLL.
+
+    Accepts the same arguments as the DLL, as python values or ctypes
+    objects, and keeps a copy of everything written to each board so
+    that it can be inspected. Transfers to a board take time in proportion
+    to their size, sleeping without the GIL as a DLL call would.
+    Sequencing is internally timed: GetCurSeqImage advances at the rate
+    set by SetSequencingRate once StartSequence has been called.
+    """
+    def __init__(self, numBoards=1, size=512, transferRate=200e6,
+                 refreshRate=1000.):
+        self.numBoards = numBoards
+        self.size = size
+        # Simulated bus throughput, in bytes per second.
+        self.transferRate = transferRate
+        # Simulated LC refresh rate, in Hz.
+        self.refreshRate = refreshRate
+        self.boards = []
+        self.frameRate = 100.
+        self.startTime = None
+        self.lock = threading.Lock()
+
+
+    def _transfer(self, nbytes):
+        if self.transferRate:
+            sleep(nbytes / float(self.transferRate))
+
+
+    def _board(self, board):
+        board = _value(board)
+        if not 0 <= board < len(self.boards):
+            raise Exception("Simulated board %s does not exist." % board)
+        return self.boards[board]
+
+
+    ## Hardware initialization
+    def Constructor(self, LCType):
+        with self.lock:
+            self.boards = [SimulatedBoard(self.size)
+                           for b in range(self.numBoards)]
+        return self.numBoards
+
+
+    def Deconstructor(self):
+        with self.lock:
+            self.boards = []
+            self.startTime = None
+
+
+    ## Image file loading
+    def ReadTIFF(self, FilePath, ImageData, ScaleWidth, ScaleHeight):
+        from PIL import Image
+        buf = _value(ImageData)
+        width, height = _value(ScaleWidth), _value(ScaleHeight)
+        image = Image.open(_value(FilePath)).resize((width, height))
+        data = numpy.asarray(image, dtype=numpy.uint16)
+        numpy.frombuffer(buf, dtype=numpy.uint16)[:] = data.ravel()
+
+
+    ## On-the-fly image loading
+    def WriteImage(self, Board, Image):
+        board = self._board(Board)
+        data = _as_array(_value(Image))
+        self._transfer(data.nbytes)
+        board.image = data
+
+
+    ## Interrupt-timed image sequencing
+    def LoadSequence(self, Board, Images, NumberOfImages):
+        board = self._board(Board)
+        n = _value(NumberOfImages)
+        data = _as_array(_value(Images))[:n * board.size * board.size]
+        self._transfer(data.nbytes)
+        board.sequence = data.reshape((n, board.size * board.size))
+        board.numImages = n
+
+
+    def SetSequencingRate(self, FrameRate):
+        self.frameRate = float(_value(FrameRate))
+
+
+    def StartSequence(self):
+        self.startTime = timer()
+
+
+    def GetCurSeqImage(self, Board):
+        board = self._board(Board)
+        if self.startTime is None or not board.numImages:
+            return 0
+        frames = int((timer() - self.startTime) * self.frameRate)
+        return frames % board.numImages
+
+
+    def StopSequence(self):
+        self.startTime = None
+
+
+    ## Hardware settings and information
+    def GetImageSize(self, Board):
+        return self._board(Board).size
+
+
+    def GetSLMPower(self, Board):
+        return self._board(Board).power
+
+
+    def SLMPower(self, Board, PowerOn):
+        self._board(Board).power = bool(_value(PowerOn))
+
+
+    def WriteCal(self, Board, CalType, Image):
+        board = self._board(Board)
+        data = _as_array(_value(Image))
+        self._transfer(data.nbytes)
+        board.cal[_value(CalType)] = data
+
+
+    def LoadLUTFile(self, Board, LUTPath):
+        self._board(Board).lut = _value(LUTPath)
+
+
+    def ComputeTF(self, FrameRate):
+        # Number of LC refresh cycles that fit in one frame period.
+        return max(1, int(self.refreshRate / float(_value(FrameRate))))
+
+
+    def SetTrueFrames(self, Board, TrueFrames):
+        self._board(Board).trueFrames = _value(TrueFrames)
+
+
+    def GetInternalTemp(self, Board, Units):
+        self._board(Board)
+        return 25.0 if _value(Units) == 0 else 77.0
@@ -16,6 +16,7 @@ limitations under the License.
 """
 
 import bnsdevice as bns
+import tiffstack
 import numpy as np
 import ctypes
 import os
@@ -66,12 +67,11 @@ dev.write_cal(1, cal)
 
 
 # Generate test images from TIFFs.
-images = []
-test_files = os.listdir(TEST_PATH)
+test_files = [os.path.join(TEST_PATH, f) for f in os.listdir(TEST_PATH)]
 print "Loading test files:"
 for f in test_files:
     print "  %s" % f
-    images.append(dev.read_tiff(f))
+images = list(tiffstack.load_stack(test_files, (dev.size, dev.size)))
 
 
 # Numerically-generated test images.
@@ -0,0 +1,321 @@
+""" Records and replays traces of calls to the BNS DLL.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A trace file is an 8-byte magic string and a 4-byte version, followed by
+fixed-size records (see RECORD_DTYPE), one per DLL call:
+  function  index into FUNCTIONS;
+  board     board index, or -1 for calls that do not address a board;
+  nbytes    total size of any image buffers passed;
+  hash      adler32 of those buffers;
+  time      start of the call, in seconds from the start of the trace;
+  duration  duration of the call in seconds;
+  value     first numeric argument after the board (frame rate, true
+            frames, calibration type, number of images ...), or NaN.
+
+To replay a trace against a simulated or a real board and compare latencies:
+  python bnstrace.py session.trace [--boards N] [--real] [--realtime]
+"""
+
+import ctypes
+import struct
+import threading
+import zlib
+import numpy
+from time import sleep
+from timeit import default_timer as timer
+
+MAGIC = b'BNSTRACE'
+VERSION = 1
+HEADER = struct.Struct('<8sI')
+
+## DLL functions, in the order of PCIe16Interface.h. Indices into this
+# tuple are stored in trace files, so only ever append to it.
+FUNCTIONS = ('Constructor', 'Deconstructor', 'ReadTIFF', 'GetTIFFInfo',
+             'WriteImage', 'LoadSequence', 'SetSequencingRate',
+             'StartSequence', 'GetCurSeqImage', 'StopSequence',
+             'GetImageSize', 'GetSLMPower', 'SLMPower', 'WriteCal',
+             'LoadLUTFile', 'ComputeTF', 'SetTrueFrames', 'GetInternalTemp')
+FUNCTION_INDEX = {name: n for n, name in enumerate(FUNCTIONS)}
+## Functions whose first argument is int Board.
+BOARD_FUNCTIONS = set(['WriteImage', 'LoadSequence', 'GetCurSeqImage',
+                       'GetImageSize', 'GetSLMPower', 'SLMPower', 'WriteCal',
+                       'LoadLUTFile', 'SetTrueFrames', 'GetInternalTemp'])
+
+RECORD_DTYPE = numpy.dtype([('function', 'u1'),
+                            ('board', 'i1'),
+                            ('nbytes', '<u4'),
+                            ('hash', '<u4'),
+                            ('time', '<f8'),
+                            ('duration', '<f8'),
+                            ('value', '<f8')])
+RECORD = struct.Struct('<BbIIddd')
+
+
+def _unwrap(arg):
+    if hasattr(arg, '_obj'):
+        # Returned by ctypes.byref.
+        return arg._obj
+    if isinstance(arg, ctypes._SimpleCData):
+        return arg.value
+    return arg
+
+
+def _describe(name, args):
+    """ Return (board, nbytes, hash, value) for a call's arguments. """
+    args = [_unwrap(arg) for arg in args]
+    board = -1
+    if name in BOARD_FUNCTIONS and args:
+        board = int(args.pop(0))
+    nbytes = 0
+    checksum = 1
+    value = float('nan')
+    for arg in args:
+        if isinstance(arg, (ctypes.Array, numpy.ndarray)):
+            data = buffer(arg)
+            nbytes += ctypes.sizeof(arg) if isinstance(arg, ctypes.Array) \
+                                         else arg.nbytes
+            checksum = zlib.adler32(data, checksum)
+        elif (isinstance(arg, (int, long, float, bool))
+                and value != value):
+            value = float(arg)
+    return board, nbytes, checksum & 0xffffffff, value
+
+
+class TraceRecorder(object):
+    """ Writes a record of each DLL call to a trace file.
+
+    Thread-safe, so one recorder may be shared by devices for several
+    boards. Each user acquires the recorder, and releases it when done; the
+    file is closed when the last user releases it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+        self.lock = threading.Lock()
+        self.start = timer()
+        self.count = 0
+        # Number of users that have acquired the recorder.
+        self.users = 0
+
+
+    def call(self, name, func, args):
+        """ Call func with args, recording the call as name. """
+        board, nbytes, checksum, value = _describe(name, args)
+        t0 = timer()
+        try:
+            return func(*args)
+        finally:
+            t1 = timer()
+            record = RECORD.pack(FUNCTION_INDEX[name], board, nbytes,
+                                 checksum, t0 - self.start, t1 - t0, value)
+            with self.lock:
+                if self.file is not None:
+                    self.file.write(record)
+                    self.count += 1
+
+
+    def acquire(self):
+        with self.lock:
+            if self.file is None:
+                raise Exception("Trace file %s is closed." % self.path)
+            self.users += 1
+        return self
+
+
+    def release(self):
+        """ Release the recorder; returns True if it was then closed. """
+        with self.lock:
+            self.users = max(0, self.users - 1)
+            if self.users:
+                return False
+        self.close()
+        return True
+
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TracingLibrary(object):
+    """ Wraps a DLL, or simulation, so that calls are recorded. """
+    def __init__(self, lib, recorder):
+        self.lib = lib
+        self.recorder = recorder
+
+
+    def __getattr__(self, name):
+        attr = getattr(self.lib, name)
+        if name not in FUNCTION_INDEX:
+            return attr
+        recorder = self.recorder
+        def wrapper(*args):
+            return recorder.call(name, attr, args)
+        # Cache the wrapper so __getattr__ is only hit once per function.
+        setattr(self, name, wrapper)
+        return wrapper
+
+
+def read_trace(path):
+    """ Read a trace file into a structured array of RECORD_DTYPE. """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise Exception("%s is not a BNS trace file." % path)
+        if version != VERSION:
+            raise Exception("Unsupported trace version %d." % version)
+        return numpy.fromfile(f, dtype=RECORD_DTYPE)
+
+
+def replay(trace, lib, realtime=False, lutPath='LUT_files/linear.lut'):
+    """ Make the calls in trace against lib; return the replayed trace.
+
+    Image buffers are zero-filled but match the recorded sizes. With
+    realtime, calls are issued at their recorded times; otherwise they
+    are made back to back. ReadTIFF and GetTIFFInfo are not replayed.
+    """
+    replayed = trace.copy()
+    replayed['duration'] = numpy.nan
+    buffers = {}
+    ushort = ctypes.c_uint16
+    start = timer()
+    for n, record in enumerate(trace):
+        name = FUNCTIONS[record['function']]
+        board = int(record['board'])
+        value = record['value']
+        nbytes = int(record['nbytes'])
+        if nbytes not in buffers:
+            buffers[nbytes] = (ushort * (nbytes // 2))()
+        buf = ctypes.byref(buffers[nbytes])
+        if name == 'Constructor':
+            args = (1,)
+        elif name == 'WriteImage':
+            args = (board, buf)
+        elif name == 'LoadSequence':
+            args = (board, buf, int(value))
+        elif name == 'SetSequencingRate':
+            args = (ctypes.c_double(value),)
+        elif name == 'ComputeTF':
+            args = (ctypes.c_float(value),)
+        elif name == 'SLMPower':
+            args = (board, bool(value))
+        elif name == 'WriteCal':
+            args = (board, int(value), buf)
+        elif name == 'LoadLUTFile':
+            args = (board, ctypes.c_char_p(lutPath))
+        elif name == 'SetTrueFrames':
+            args = (board, int(value))
+        elif name == 'GetInternalTemp':
+            args = (board, 0)
+        elif name in BOARD_FUNCTIONS:
+            args = (board,)
+        elif name in ('ReadTIFF', 'GetTIFFInfo'):
+            continue
+        else:
+            args = ()
+        if realtime:
+            delay = record['time'] - (timer() - start)
+            if delay > 0:
+                sleep(delay)
+        func = getattr(lib, name)
+        t0 = timer()
+        func(*args)
+        t1 = timer()
+        replayed[n]['time'] = t0 - start
+        replayed[n]['duration'] = t1 - t0
+    return replayed
+
+
+def compare(recorded, replayed, percentiles=(50, 90, 99)):
+    """ Compare latency distributions per function.
+
+    Returns a dict mapping function name to a dict with the call count and,
+    for each of 'recorded' and 'replayed', the given percentiles and the
+    maximum duration, in seconds.
+    """
+    results = {}
+    for index in numpy.unique(recorded['function']):
+        mask = recorded['function'] == index
+        before = recorded['duration'][mask]
+        after = replayed['duration'][mask]
+        after = after[~numpy.isnan(after)]
+        if not len(after):
+            continue
+        results[FUNCTIONS[index]] = {
+            'count': int(mask.sum()),
+            'recorded': list(numpy.percentile(before, percentiles)) \
+                        + [before.max()],
+            'replayed': list(numpy.percentile(after, percentiles)) \
+                        + [after.max()]}
+    return results
+
+
+def format_report(comparison, percentiles=(50, 90, 99)):
+    """ Format the result of compare as a table of latencies in ms. """
+    columns = ['p%d' % p for p in percentiles] + ['max']
+    lines = ['%-18s %6s  %-6s ' % ('function', 'calls', '')
+             + ' '.join('%9s' % c for c in columns)
+             + '  %8s' % 'p50 chg']
+    for name in sorted(comparison):
+        entry = comparison[name]
+        for which in ('recorded', 'replayed'):
+            line = '%-18s %6s  %-6s ' % (
+                name if which == 'recorded' else '',
+                entry['count'] if which == 'recorded' else '',
+                which[:6])
+            line += ' '.join('%9.3f' % (1000 * t) for t in entry[which])
+            if which == 'replayed' and entry['recorded'][0] > 0:
+                change = entry['replayed'][0] / entry['recorded'][0] - 1
+                line += '  %+7.1f%%' % (100 * change)
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Replay a BNS DLL call trace and compare latencies.')
+    parser.add_argument('trace', help='trace file recorded by BNSDevice')
+    parser.add_argument('--real', action='store_true',
+                        help='replay against the real DLL')
+    parser.add_argument('--boards', type=int, default=None,
+                        help='number of simulated boards')
+    parser.add_argument('--realtime', action='store_true',
+                        help='issue calls at their recorded times')
+    parser.add_argument('--lut', default='LUT_files/linear.lut',
+                        help='LUT file passed to LoadLUTFile')
+    options = parser.parse_args()
+
+    recorded = read_trace(options.trace)
+    import bnsinterface
+    if options.real:
+        lib = bnsinterface.load('PCIe16Interface')
+    else:
+        import bnssim
+        boards = options.boards or max(1, int(recorded['board'].max()) + 1)
+        lib = bnsinterface.wrap(bnssim.SimulatedLibrary(boards))
+    if not len(recorded) or FUNCTIONS[recorded[0]['function']] != 'Constructor':
+        # Trace started on an initialized device.
+        lib.Constructor(1)
+    replayed = replay(recorded, lib, options.realtime, options.lut)
+    print format_report(compare(recorded, replayed))
+
+
+if __name__ == '__main__':
+    main()
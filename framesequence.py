@@ -0,0 +1,182 @@
+""" Image sequences stored as unique frames plus an index vector.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import numpy
+
+
+def content_key(*parts):
+    """ Return a key identifying the contents of buffers and values.
+
+    Buffers (e.g. contiguous ndarrays) are hashed by content; other parts
+    are included as they are.
+    """
+    key = []
+    for part in parts:
+        if hasattr(part, 'data') and hasattr(part, 'dtype'):
+            key.append((part.shape, part.dtype.str,
+                        hashlib.md5(part.data).digest()))
+        else:
+            key.append(part)
+    return tuple(key)
+
+
+def frame_digest(frame):
+    """ Return a digest of a frame's shape, type and contents. """
+    frame = numpy.ascontiguousarray(frame)
+    digest = hashlib.md5(str((frame.shape, frame.dtype.str)))
+    digest.update(frame.data)
+    return digest.digest()
+
+
+class FrameSequence(object):
+    """ A sequence of frames in which repeated frames are stored once.
+
+    Frames are added with a key that identifies their content: a frame is
+    only generated for the first occurrence of its key, and later ones
+    refer back to it. Indexing and iteration give the full sequence.
+    """
+    def __init__(self):
+        # Unique frames, in order of first occurrence.
+        self.frames = []
+        # Position in self.frames of each frame in the sequence.
+        self.index = []
+        # Map of key to position in self.frames.
+        self.keys = {}
+        # Digest of each unique frame's contents, computed as it is added.
+        self.digests = []
+        # The full sequence as one contiguous ctypes array ready to upload,
+        # if it was built in one; otherwise None.
+        self.buffer = None
+
+
+    def add(self, key, make):
+        """ Append the frame for key, calling make() if it is new.
+
+        Returns the frame's position in the table of unique frames.
+        """
+        n = self.keys.get(key)
+        if n is None:
+            n = len(self.frames)
+            frame = make()
+            self.frames.append(frame)
+            self.digests.append(frame_digest(frame))
+            self.keys[key] = n
+        self.index.append(n)
+        return n
+
+
+    @classmethod
+    def from_keys(cls, keys, render):
+        """ Build a sequence with a frame for each of keys.
+
+        render(unique) is called once, with the distinct keys in order of
+        first occurrence, and must return their frames in the same order.
+        """
+        sequence = cls()
+        unique = []
+        for key in keys:
+            n = sequence.keys.get(key)
+            if n is None:
+                n = len(unique)
+                unique.append(key)
+                sequence.keys[key] = n
+            sequence.index.append(n)
+        sequence.frames = list(render(unique))
+        sequence.digests = [frame_digest(f) for f in sequence.frames]
+        return sequence
+
+
+    def digest(self):
+        """ Return a digest of the contents of the full sequence.
+
+        Sequences of identical frames in the same order have the same
+        digest, however the frames were generated.
+        """
+        digest = hashlib.md5(str(len(self.index)))
+        digests = self.digests
+        for n in self.index:
+            digest.update(digests[n])
+        return digest.digest()
+
+
+    @classmethod
+    def builder(cls, frames, buffer=None):
+        """ Return a SequenceBuilder writing into frames; see below. """
+        return SequenceBuilder(cls(), frames, buffer)
+
+
+    def expand(self):
+        """ Return the full sequence as a list of references to frames. """
+        frames = self.frames
+        return [frames[n] for n in self.index]
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def __getitem__(self, i):
+        return self.frames[self.index[i]]
+
+
+    def __iter__(self):
+        frames = self.frames
+        return (frames[n] for n in self.index)
+
+
+class SequenceBuilder(object):
+    """ Builds a FrameSequence a frame at a time, in a preallocated array.
+
+    frames is an array with a slot for every frame of the full sequence,
+    e.g. a view of buffer, the upload buffer. New frames are rendered
+    straight into their slot; repeats are copied from the first one.
+    Unique frames in the result refer to their slots in frames.
+    """
+    def __init__(self, sequence, frames, buffer=None):
+        self.sequence = sequence
+        self.frames = frames
+        self.buffer = buffer
+
+
+    def add(self, key, render):
+        """ Append the frame for key, calling render(out) if it is new.
+
+        render must write the frame into the array out.
+        """
+        n = len(self.sequence)
+        if n == len(self.frames):
+            raise Exception('More than the %d frames expected.' 
+                            % len(self.frames))
+        out = self.frames[n]
+        unique = len(self.sequence.frames)
+        def make():
+            render(out)
+            return out
+        m = self.sequence.add(key, make)
+        if m < unique:
+            out[...] = self.sequence.frames[m]
+        return m
+
+
+    def finish(self):
+        """ Return the sequence, once every frame has been added. """
+        if len(self.sequence) != len(self.frames):
+            raise Exception('Expected %d frames, got %d.' 
+                            % (len(self.frames), len(self.sequence)))
+        self.sequence.buffer = self.buffer
+        return self.sequence
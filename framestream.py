@@ -0,0 +1,264 @@
+""" Software-timed streaming of frames to the SLM with write_image.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+For sequences too long for LoadSequence, frames are displayed one at a time
+by a high-priority thread at a fixed rate. Frames come from a bounded
+prefetch queue, filled ahead of time by put() or from an iterable.
+"""
+
+import ctypes
+import threading
+import Queue
+import numpy
+from time import sleep
+from timeit import default_timer as timer
+
+## Record layout for per-frame timing. Times in s from start of stream.
+TIMING_DTYPE = numpy.dtype([('slot', numpy.int64),
+                            ('scheduled', numpy.float64),
+                            ('written', numpy.float64),
+                            ('duration', numpy.float64)])
+## Final wait before a frame is spun rather than slept, in s.
+SPIN_TIME = 0.002
+THREAD_PRIORITY_TIME_CRITICAL = 15
+## Marks the end of the stream in the queue.
+_END = object()
+
+
+def _raise_priority():
+    """ Make the calling thread time-critical, where the OS allows. """
+    try:
+        kernel32 = ctypes.windll.kernel32
+    except AttributeError:
+        # Not on Windows.
+        return
+    kernel32.SetThreadPriority(kernel32.GetCurrentThread(),
+                               THREAD_PRIORITY_TIME_CRITICAL)
+
+
+def _set_timer_resolution(enable):
+    """ Request 1 ms scheduler resolution on Windows while streaming. """
+    try:
+        winmm = ctypes.windll.winmm
+    except AttributeError:
+        return
+    if enable:
+        winmm.timeBeginPeriod(1)
+    else:
+        winmm.timeEndPeriod(1)
+
+
+class FrameStreamer(object):
+    """ Writes queued frames to a device at a target frame rate.
+
+    Frame n is due at n / rate s after start. If no frame is queued when a
+    slot is due, that slot is an underrun: the previous frame stays up and
+    the next frame goes in the next slot, so the schedule does not slip.
+    Per-frame timing is kept in a ring buffer of the last size frames.
+    Each write is made holding hardwareLock, if given, so that it does not
+    run alongside other calls to the device.
+    """
+    def __init__(self, hardware, rate, prefetch=32, source=None, size=65536,
+                 hardwareLock=None):
+        self.hardware = hardware
+        self.hardwareLock = hardwareLock or threading.Lock()
+        self.rate = float(rate)
+        self.queue = Queue.Queue(prefetch)
+        # Optional iterable of frames, consumed by a producer thread.
+        self.source = source
+        self.timing = numpy.zeros(size, dtype=TIMING_DTYPE)
+        self.frames = 0
+        self.underruns = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.run_flag = False
+        self.finished = threading.Event()
+        self.threads = []
+
+
+    def put(self, frame, timeout=None):
+        """ Queue a frame, blocking while the queue is full.
+
+        The frame is made a contiguous uint16 buffer here, in the
+        caller's thread, so that the streaming thread only has to write it.
+        """
+        self.queue.put(self.hardware.as_buffer(frame), timeout=timeout)
+
+
+    def finish(self):
+        """ Mark the end of the stream: stop after the queued frames. """
+        self.queue.put(_END)
+
+
+    def _produce(self):
+        for frame in self.source:
+            if not self.run_flag:
+                return
+            self.put(frame)
+        if self.run_flag:
+            self.finish()
+
+
+    def _record(self, slot, scheduled, written, duration):
+        with self.lock:
+            n = self.frames % len(self.timing)
+            self.timing[n] = (slot, scheduled, written, duration)
+            self.frames += 1
+
+
+    def _acquire_hardware(self):
+        """ Take the hardware lock; False if stopped while waiting for it.
+
+        Polled rather than blocking, so that stop() may be called by a
+        thread that holds the lock.
+        """
+        while not self.hardwareLock.acquire(False):
+            if not self.run_flag:
+                return False
+            sleep(0.0001)
+        return True
+
+
+    def _stream(self):
+        _raise_priority()
+        _set_timer_resolution(True)
+        period = 1. / self.rate
+        try:
+            start = timer()
+            slot = 0
+            while self.run_flag:
+                due = start + slot * period
+                delay = due - timer()
+                if delay > SPIN_TIME:
+                    sleep(delay - SPIN_TIME)
+                while timer() < due:
+                    # Yield, so the GIL isn't held against other threads.
+                    sleep(0)
+                try:
+                    frame = self.queue.get_nowait()
+                except Queue.Empty:
+                    with self.lock:
+                        self.underruns += 1
+                    slot += 1
+                    continue
+                if frame is _END:
+                    break
+                if not self._acquire_hardware():
+                    break
+                try:
+                    t0 = timer()
+                    self.hardware.write_image(frame)
+                    t1 = timer()
+                finally:
+                    self.hardwareLock.release()
+                self._record(slot, due - start, t0 - start, t1 - t0)
+                # If a write overran one or more slots, skip them rather
+                # than trying to catch up.
+                slot += 1
+                overrun = int((t1 - start) / period) + 1 - slot
+                if overrun > 0:
+                    with self.lock:
+                        self.skipped += overrun
+                    slot += overrun
+        finally:
+            _set_timer_resolution(False)
+            self.finished.set()
+
+
+    def start(self):
+        """ Start streaming; frames already queued are shown first.
+
+        With a source, streaming starts once the queue has been filled
+        or the source exhausted.
+        """
+        self.run_flag = True
+        self.finished.clear()
+        self.threads = []
+        if self.source is not None:
+            producer = threading.Thread(target=self._produce)
+            producer.daemon = True
+            producer.start()
+            self.threads.append(producer)
+            while producer.is_alive() and not self.queue.full():
+                sleep(0.001)
+        streamer = threading.Thread(target=self._stream)
+        streamer.daemon = True
+        streamer.start()
+        self.threads.append(streamer)
+
+
+    def stop(self):
+        """ Stop streaming now, discarding any queued frames. """
+        self.run_flag = False
+        # Unblock a producer waiting on a full queue.
+        while True:
+            try:
+                self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+    def wait(self, timeout=None):
+        """ Wait for the stream to reach its end; True if it did. """
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+
+    def get_timing(self):
+        """ Return per-frame timing records in order. """
+        with self.lock:
+            n = self.frames % len(self.timing)
+            if self.frames <= len(self.timing):
+                return self.timing[:self.frames].copy()
+            return numpy.concatenate((self.timing[n:], self.timing[:n]))
+
+
+    def get_statistics(self):
+        """ Return a dict summarizing frame timing.
+
+        frames:    number of frames written;
+        underruns: slots at which no frame was ready;
+        skipped:   slots lost to writes that overran a frame period;
+        rate:      achieved frame rate in Hz;
+        jitter:    standard deviation of write start from schedule in s;
+        max_late:  greatest delay of a write start from schedule in s;
+        write_time, max_write_time: mean and greatest write_image time in s.
+        Statistics other than counts cover the frames in the ring buffer.
+        """
+        timing = self.get_timing()
+        with self.lock:
+            stats = {'frames': self.frames,
+                     'underruns': self.underruns,
+                     'skipped': self.skipped,
+                     'rate': 0.,
+                     'jitter': 0.,
+                     'max_late': 0.,
+                     'write_time': 0.,
+                     'max_write_time': 0.}
+        if not len(timing):
+            return stats
+        late = timing['written'] - timing['scheduled']
+        stats['jitter'] = late.std()
+        stats['max_late'] = late.max()
+        stats['write_time'] = timing['duration'].mean()
+        stats['max_write_time'] = timing['duration'].max()
+        if len(timing) > 1:
+            span = timing['written'][-1] - timing['written'][0]
+            stats['rate'] = (len(timing) - 1) / span if span > 0 else 0.
+        return stats
@@ -0,0 +1,108 @@
+""" Phase-only holograms by Gerchberg-Saxton iteration.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+The SLM is taken to be in the back focal plane of a lens, so the target
+plane is the Fourier transform of the SLM field. Targets are intensity
+images with the zero order at their centre.
+"""
+
+import numpy
+from numpy import fft
+from timeit import default_timer as timer
+
+AXES = (-2, -1)
+TWO_PI = 2. * numpy.pi
+
+
+class GerchbergSaxton(object):
+    """ Computes SLM phase patterns that produce target intensities.
+
+    A batch of targets is transformed together, so per-call overhead is
+    shared between frames. Work buffers are kept between calls for the
+    last batch size only; numpy.fft caches its own plans for each transform
+    size. numpy.fft has no out argument, so each transform still returns a
+    new complex array, as does drawing the random starting phase.
+    """
+    def __init__(self, shape, seed=0):
+        self.shape = tuple(shape)
+        self.seed = seed
+        # Batch size and its work buffers: target amplitude, magnitude
+        # scratch, starting field.
+        self._buffers = (None, None)
+
+
+    def _get_buffers(self, n):
+        if self._buffers[0] != n:
+            # Release the old buffers before allocating new ones.
+            self._buffers = (None, None)
+            shape = (n,) + self.shape
+            self._buffers = (n, (numpy.empty(shape, dtype=numpy.float64),
+                                 numpy.empty(shape, dtype=numpy.float64),
+                                 numpy.empty(shape, dtype=numpy.complex128)))
+        return self._buffers[1]
+
+
+    @staticmethod
+    def _normalize(field, scratch):
+        """ Reduce field to unit magnitude in place, using scratch. """
+        numpy.abs(field, out=scratch)
+        # Leave zeros as zeros rather than dividing by them.
+        scratch[scratch == 0] = 1.
+        field /= scratch
+
+
+    def compute(self, targets, iterations=20):
+        """ Return (phases, timings) for one or more target intensities.
+
+        targets is an (H, W) image or (N, H, W) stack of intensities.
+        phases is an (N, H, W) array of SLM phase in [0, 2 pi); timings
+        lists the time taken by each iteration, in seconds.
+        """
+        targets = numpy.asarray(targets, dtype=numpy.float64)
+        if targets.ndim == 2:
+            targets = targets[numpy.newaxis]
+        if targets.shape[1:] != self.shape:
+            raise Exception("Targets must be %s, not %s."
+                            % (self.shape, targets.shape[1:]))
+        amplitude, scratch, field = self._get_buffers(len(targets))
+        # Move the target centre to the zero order.
+        numpy.sqrt(fft.ifftshift(targets, axes=AXES), out=amplitude)
+
+        # Start from the target amplitude with random phase.
+        random = numpy.random.RandomState(self.seed)
+        numpy.multiply(random.random_sample(amplitude.shape), TWO_PI,
+                       out=scratch)
+        field.real = 0.
+        field.imag = scratch
+        numpy.exp(field, out=field)
+        field *= amplitude
+
+        timings = []
+        for i in range(iterations):
+            t0 = timer()
+            # Back to the SLM: keep the phase only.
+            slm = fft.ifft2(field, axes=AXES)
+            self._normalize(slm, scratch)
+            # Forward to the target: impose the target amplitude.
+            field = fft.fft2(slm, axes=AXES)
+            self._normalize(field, scratch)
+            field *= amplitude
+            timings.append(timer() - t0)
+        if not iterations:
+            slm = fft.ifft2(field, axes=AXES)
+        phases = numpy.angle(slm)
+        numpy.mod(phases, TWO_PI, out=phases)
+        return phases, timings
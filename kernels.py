@@ -0,0 +1,238 @@
+""" Interchangeable implementations of the pattern kernels.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Two kernels do most of the work of pattern generation:
+  grating, the 16-bit cosine grating
+    rint(offset + amplitude * cos(phase + (cx k + cy l) 2 pi / pitch))
+  for pixel column and row indices k and l; and
+  lut_map, which drops the two LSBs of a 16-bit pattern and passes it
+  through a LUT.
+NumPy implements both; numexpr and numba implementations are used if those
+packages are installed. calibrate() times each backend on a given geometry,
+and selects the fastest one whose output is identical to NumPy's.
+"""
+
+import threading
+import numpy
+from collections import OrderedDict
+from timeit import default_timer as timer
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+try:
+    import numba
+except ImportError:
+    numba = None
+
+TWO_PI = 2. * numpy.pi
+
+
+class NumpyBackend(object):
+    """ Reference implementation of the kernels. """
+    name = 'numpy'
+
+    def grating(self, k, l, cx, cy, pitch, phase, offset, amplitude,
+                out=None):
+        """ Return the grating at indices k and l as uint16.
+
+        Parameters may be arrays that broadcast against k and l, e.g. with
+        one value for each frame of a stack; with out, the result is written
+        there. Stacks are evaluated a frame at a time in one work buffer,
+        which stays in cache, rather than in full-size temporaries.
+        """
+        shape = numpy.broadcast(k, l, cx, cy, phase).shape
+        if out is None:
+            out = numpy.empty(shape, dtype=numpy.uint16)
+        work = numpy.empty(shape[-2:], dtype=numpy.float64)
+        if len(shape) <= 2:
+            self._grating(k, l, cx, cy, pitch, phase, offset, amplitude,
+                          work, out)
+            return out
+        stacked = [numpy.broadcast_to(p, shape) for p in (k, l, cx, cy, phase)]
+        for n in numpy.ndindex(shape[:-2]):
+            k_n, l_n, cx_n, cy_n, phase_n = [p[n] for p in stacked]
+            self._grating(k_n, l_n, cx_n, cy_n, pitch, phase_n, offset,
+                          amplitude, work, out[n])
+        return out
+
+
+    @staticmethod
+    def _grating(k, l, cx, cy, pitch, phase, offset, amplitude, work, out):
+        """ Evaluate one frame, or vector, in work; cast into out. """
+        numpy.multiply(cx, k, out=work)
+        work += cy * l
+        work *= TWO_PI / pitch
+        work += phase
+        numpy.cos(work, out=work)
+        work *= amplitude
+        work += offset
+        numpy.rint(work, out=work)
+        out[...] = work
+
+
+    def lut_map(self, lut, pattern16):
+        """ Return pattern16, less its two LSBs, passed through lut. """
+        return lut[pattern16 >> 2]
+
+
+class NumexprBackend(NumpyBackend):
+    """ Evaluates the grating with numexpr, in one pass over memory. """
+    name = 'numexpr'
+    expression = ('offset + amplitude * cos('
+                  'phase + (cx * k + cy * l) * scale)')
+
+    def grating(self, k, l, cx, cy, pitch, phase, offset, amplitude,
+                out=None):
+        values = numexpr.evaluate(self.expression, local_dict={
+            'k': k, 'l': l, 'cx': cx, 'cy': cy, 'scale': TWO_PI / pitch,
+            'phase': phase, 'offset': offset, 'amplitude': amplitude})
+        return _cast(numpy.rint(values, out=values), out)
+
+
+if numba is not None:
+    @numba.njit(nogil=True)
+    def _numba_grating(k, l, cx, cy, scale, phase, offset, amplitude, out):
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] = numpy.rint(offset + amplitude * numpy.cos(
+                    phase + (cx * k[i, j] + cy * l[i, j]) * scale))
+
+
+    @numba.njit(nogil=True)
+    def _numba_lut_map(lut, pattern16, out):
+        for i in range(out.shape[0]):
+            for j in range(out.shape[1]):
+                out[i, j] = lut[pattern16[i, j] >> 2]
+
+
+class NumbaBackend(NumpyBackend):
+    """ Compiled loops, without temporary arrays; releases the GIL. """
+    name = 'numba'
+
+    def grating(self, k, l, cx, cy, pitch, phase, offset, amplitude,
+                out=None):
+        k, l = numpy.broadcast_arrays(k, l)
+        if k.ndim > 2 or any(numpy.ndim(p) for p in (cx, cy, phase)):
+            # Stacks, e.g. with parameters for each frame.
+            return NumpyBackend.grating(self, k, l, cx, cy, pitch, phase,
+                                        offset, amplitude, out)
+        # Vectors, e.g. of pixels in a region, are evaluated as one row.
+        if out is None:
+            out = numpy.empty(k.shape, dtype=numpy.uint16)
+        _numba_grating(numpy.atleast_2d(k), numpy.atleast_2d(l), float(cx),
+                       float(cy), TWO_PI / pitch, float(phase), float(offset),
+                       float(amplitude), numpy.atleast_2d(out))
+        return out
+
+
+    def lut_map(self, lut, pattern16):
+        if pattern16.ndim > 2:
+            return NumpyBackend.lut_map(self, lut, pattern16)
+        out = numpy.empty(pattern16.shape, dtype=lut.dtype)
+        _numba_lut_map(lut, numpy.atleast_2d(pattern16),
+                       numpy.atleast_2d(out))
+        return out
+
+
+## Backends by name, with the reference first.
+BACKENDS = OrderedDict([('numpy', NumpyBackend)])
+if numexpr is not None:
+    BACKENDS['numexpr'] = NumexprBackend
+if numba is not None:
+    BACKENDS['numba'] = NumbaBackend
+
+_lock = threading.Lock()
+_backend = NumpyBackend()
+
+
+def _cast(values, out):
+    """ Return values as uint16, in out if given. """
+    if out is None:
+        return numpy.ushort(values)
+    out[...] = values
+    return out
+
+
+def get_backends():
+    """ Return the names of the available backends. """
+    return list(BACKENDS)
+
+
+def set_backend(name):
+    """ Use the backend called name for all kernels. """
+    global _backend
+    if name not in BACKENDS:
+        raise Exception("Backend %s is not available: not one of %s."
+                        % (name, get_backends()))
+    with _lock:
+        _backend = BACKENDS[name]()
+
+
+def get_backend():
+    return _backend
+
+
+def grating(k, l, cx, cy, pitch, phase, offset, amplitude, out=None):
+    return _backend.grating(k, l, cx, cy, pitch, phase, offset, amplitude,
+                            out)
+
+
+def lut_map(lut, pattern16):
+    return _backend.lut_map(lut, pattern16)
+
+
+def calibrate(shape, frames, repeats=3):
+    """ Select the fastest backend for frames frames of shape.
+
+    Each backend renders the same test gratings and LUT maps; those whose
+    output differs from NumPy's are not used. Returns (name, timings,
+    mismatched): the backend selected, the best time for each backend in
+    s, and the names of those that did not match.
+    """
+    k, l = numpy.meshgrid(numpy.arange(shape[1]), numpy.arange(shape[0]))
+    lut = numpy.arange(16384, dtype=numpy.uint16)[::-1].copy()
+    params = [(numpy.cos(a), numpy.sin(a), 7.3 + a, a / 3.)
+              for a in numpy.linspace(0, TWO_PI, frames, endpoint=False)]
+
+    def run(backend):
+        return [backend.lut_map(lut, backend.grating(
+                    k, l, cx, cy, pitch, phase, 0.5 * 27306., 0.5 * 27306.))
+                for (cx, cy, pitch, phase) in params]
+
+    reference = None
+    timings = {}
+    mismatched = []
+    for name, cls in BACKENDS.items():
+        backend = cls()
+        # The first run also compiles, where that applies.
+        result = run(backend)
+        if reference is None:
+            reference = result
+        elif not all(numpy.array_equal(a, b)
+                     for a, b in zip(reference, result)):
+            mismatched.append(name)
+            continue
+        best = None
+        for i in range(repeats):
+            t0 = timer()
+            run(backend)
+            elapsed = timer() - t0
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    name = min(timings, key=timings.get)
+    set_backend(name)
+    return name, timings, mismatched
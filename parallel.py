@@ -0,0 +1,84 @@
+""" Tile-parallel evaluation of image stacks on a persistent thread pool.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+NumPy releases the GIL inside ufuncs and indexing, so a stack of frames
+split into row tiles can be evaluated on several cores from threads. Each
+tile is computed by the same elementwise operations as the whole frame,
+so the result is identical to evaluating frames serially.
+"""
+
+import multiprocessing
+import threading
+import numpy
+from multiprocessing.pool import ThreadPool
+
+## Rows per tile: small enough to balance the load across threads, large
+# enough that dispatch overhead is negligible.
+TILE_ROWS = 64
+
+_lock = threading.Lock()
+_pool = None
+_threads = multiprocessing.cpu_count()
+
+
+def set_threads(threads):
+    """ Set the number of worker threads; 1 evaluates serially. """
+    global _pool, _threads
+    with _lock:
+        if _pool is not None:
+            _pool.close()
+            _pool.join()
+            _pool = None
+        _threads = max(1, int(threads))
+
+
+def get_threads():
+    return _threads
+
+
+def _get_pool():
+    global _pool
+    with _lock:
+        if _pool is None and _threads > 1:
+            _pool = ThreadPool(_threads)
+        return _pool
+
+
+def render_frames(count, shape, kernel, dtype=numpy.uint16,
+                  tile_rows=TILE_ROWS, out=None):
+    """ Evaluate a stack of count frames of shape, tile by tile.
+
+    kernel(n, rows) must return the values of frame n for the row slice
+    rows, i.e. an array of shape (rows.stop - rows.start, shape[1]).
+    Returns a (count,) + shape array of dtype, or fills and returns out.
+    """
+    if out is None:
+        out = numpy.empty((count,) + tuple(shape), dtype=dtype)
+    tiles = [slice(start, min(start + tile_rows, shape[0]))
+             for start in range(0, shape[0], tile_rows)]
+    tasks = [(n, rows) for n in range(count) for rows in tiles]
+
+    def run(task):
+        n, rows = task
+        out[n, rows] = kernel(n, rows)
+
+    pool = _get_pool()
+    if pool is None or len(tasks) < 2:
+        for task in tasks:
+            run(task)
+    else:
+        pool.map(run, tasks)
+    return out
@@ -0,0 +1,152 @@
+""" Profiles of calls to a running service.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A CallProfiler wraps functions so that each call is profiled, and adds the
+results up across calls and threads. Nothing is wrapped, so nothing costs
+anything, until profiling starts.
+Kinds are 'cprofile', for time by function, and 'tracemalloc', for memory
+allocated by source line; tracemalloc needs Python 3.4 or the pytracemalloc
+package.
+"""
+
+import cProfile
+import pstats
+import threading
+from functools import wraps
+from timeit import default_timer as timer
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+KINDS = ('cprofile', 'tracemalloc')
+
+
+class CallProfiler(object):
+    """ Aggregates profiles of calls to the functions that it wraps.
+
+    Only the outermost wrapped call in each thread is profiled, so calls
+    that wrapped functions make to each other are counted once.
+    """
+    def __init__(self, kind='cprofile'):
+        if kind not in KINDS:
+            raise Exception("Unknown profile kind %s: not one of %s."
+                            % (kind, KINDS))
+        if kind == 'tracemalloc':
+            if tracemalloc is None:
+                raise Exception("tracemalloc is not available.")
+            # Leave tracing on at the end if someone else started it.
+            self._stop_tracing = not tracemalloc.is_tracing()
+            tracemalloc.start()
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.start_time = timer()
+        self.calls = 0
+        # Time profile, as pstats.Stats, for cprofile.
+        self.stats = None
+        # Map of 'file:line' to net (bytes, blocks) allocated, for
+        # tracemalloc.
+        self.sites = {}
+        self._local = threading.local()
+
+
+    def wrap(self, func):
+        """ Return a function that calls func and profiles the call. """
+        profile_call = {'cprofile': self._profile_time,
+                        'tracemalloc': self._profile_memory}[self.kind]
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if getattr(self._local, 'active', False):
+                return func(*args, **kwargs)
+            self._local.active = True
+            try:
+                return profile_call(func, args, kwargs)
+            finally:
+                self._local.active = False
+        return wrapper
+
+
+    def _profile_time(self, func, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                self.calls += 1
+                if self.stats is None:
+                    self.stats = pstats.Stats(profile)
+                else:
+                    self.stats.add(profile)
+
+
+    def _profile_memory(self, func, args, kwargs):
+        before = tracemalloc.take_snapshot()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            after = tracemalloc.take_snapshot()
+            # Leave out the snapshots themselves.
+            ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+            differences = after.filter_traces(ignore).compare_to(
+                before.filter_traces(ignore), 'lineno')
+            with self.lock:
+                self.calls += 1
+                for difference in differences:
+                    frame = difference.traceback[0]
+                    site = '%s:%d' % (frame.filename, frame.lineno)
+                    size, count = self.sites.get(site, (0, 0))
+                    self.sites[site] = (size + difference.size_diff,
+                                        count + difference.count_diff)
+
+
+    def finish(self, path=None, top=20):
+        """ Stop profiling and return the results as a dict.
+
+        The dict holds the kind, the number of calls profiled, the duration
+        of the profile in s, and the top entries:
+          for cprofile, (function, calls, own time, cumulative time),
+            by cumulative time;
+          for tracemalloc, (site, bytes, blocks), by bytes allocated.
+        With path, the full results are also written there: for cprofile,
+        as a .prof file that pstats and most profile viewers can read.
+        """
+        if self.kind == 'tracemalloc' and self._stop_tracing:
+            tracemalloc.stop()
+        with self.lock:
+            result = {'kind': self.kind,
+                      'calls': self.calls,
+                      'duration': timer() - self.start_time,
+                      'path': path}
+            if self.kind == 'cprofile':
+                entries = []
+                if self.stats is not None:
+                    self.stats.sort_stats('cumulative')
+                    for func in self.stats.fcn_list[:top]:
+                        cc, nc, tt, ct, callers = self.stats.stats[func]
+                        entries.append(('%s:%d(%s)' % func, nc, tt, ct))
+                    if path:
+                        self.stats.dump_stats(path)
+            else:
+                entries = sorted(((site, size, count)
+                                  for site, (size, count) in self.sites.items()),
+                                 key=lambda entry: -abs(entry[1]))
+                if path:
+                    with open(path, 'w') as f:
+                        for entry in entries:
+                            f.write('%s\t%d\t%d\n' % entry)
+                entries = entries[:top]
+            result['top'] = entries
+        return result
@@ -0,0 +1,216 @@
+""" Samples the SLM sequence position to build a trigger timeline.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import logging
+import threading
+import numpy
+from time import sleep
+# time.clock on Windows, time.time elsewhere: the best resolution available.
+from timeit import default_timer as timer
+
+## Record layout for the timeline: one entry per observed index change.
+SAMPLE_DTYPE = numpy.dtype([('time', numpy.float64), ('index', numpy.int32)])
+
+logger = logging.getLogger(__name__)
+
+
+class SequenceSampler(object):
+    """ Polls the current sequence image from a thread into a ring buffer.
+
+    Only changes of index are stored, so the buffer holds a timeline of
+    (timestamp, index) pairs, one per frame transition; the first poll
+    after start() is always stored to anchor the timeline. Indices are
+    as reported by the hardware, i.e. the image that will be displayed
+    on the next trigger. If a poll fails, sampling stops, and the error is
+    kept in error and reported by stop() and get_statistics().
+    """
+    def __init__(self, hardware, rate=2000., size=65536, hardwareLock=None):
+        # The device to poll: anything with a curr_seq_image property.
+        self.hardware = hardware
+        # Held for each poll, so polls don't run alongside other DLL calls.
+        self.hardwareLock = hardwareLock or threading.Lock()
+        # Target polling rate in Hz.
+        self.rate = float(rate)
+        # Ring buffer and write position.
+        self.buffer = numpy.zeros(size, dtype=SAMPLE_DTYPE)
+        self.position = 0
+        # Number of records written since last clear, including overwritten.
+        self.count = 0
+        # Number of polls since last clear, to report the achieved rate.
+        self.polls = 0
+        # Last index recorded; None until the timeline is anchored.
+        self.last = None
+        self.start_time = None
+        self.stop_time = None
+        self.lock = threading.Lock()
+        self.run_flag = False
+        self.thread = None
+        # Error that stopped sampling, as a string, if any.
+        self.error = None
+
+
+    def _record(self, t, index):
+        n = self.position
+        self.buffer[n] = (t, index)
+        self.position = (n + 1) % len(self.buffer)
+        self.count += 1
+
+
+    def _run(self):
+        period = 1. / self.rate
+        next_poll = timer()
+        while self.run_flag:
+            try:
+                with self.hardwareLock:
+                    index = self.hardware.curr_seq_image
+            except Exception as e:
+                logger.error('Sequence sampling stopped: %s' % e)
+                with self.lock:
+                    self.error = '%s: %s' % (type(e).__name__, e)
+                    self.stop_time = timer()
+                self.run_flag = False
+                break
+            t = timer()
+            with self.lock:
+                self.polls += 1
+                if index != self.last:
+                    self._record(t, index)
+                    self.last = index
+            # Schedule against absolute times so that the rate doesn't drift;
+            # if we have fallen behind, poll again immediately.
+            next_poll += period
+            delay = next_poll - timer()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_poll = timer()
+
+
+    def clear(self):
+        """ Discard all recorded data. """
+        with self.lock:
+            self.position = 0
+            self.count = 0
+            self.polls = 0
+            # The next poll anchors the new timeline.
+            self.last = None
+            self.start_time = timer() if self.run_flag else None
+            self.stop_time = None
+
+
+    def start(self):
+        """ Start polling in a new thread. """
+        if self.run_flag:
+            return
+        self.clear()
+        self.error = None
+        self.run_flag = True
+        self.start_time = timer()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def stop(self):
+        """ Stop polling and wait for the thread to finish.
+
+        Returns the error that stopped sampling early, or None.
+        """
+        self.run_flag = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is None:
+            self.stop_time = timer()
+        return self.error
+
+
+    def get_timeline(self):
+        """ Return recorded (time, index) records in chronological order.
+
+        Times are in seconds relative to the start of sampling.
+        """
+        with self.lock:
+            size = len(self.buffer)
+            if self.count < size:
+                data = self.buffer[:self.position].copy()
+            else:
+                data = numpy.concatenate((self.buffer[self.position:],
+                                          self.buffer[:self.position]))
+            start = self.start_time
+        if start is not None:
+            data['time'] -= start
+        return data
+
+
+    def get_statistics(self, sequence_length=None):
+        """ Derive frame timing statistics from the timeline.
+
+        sequence_length is needed to unwrap indices at the end of the
+        sequence; if not given, it is taken as one more than the highest
+        index seen.
+        Returns a dict with:
+          frame_rate:  mean transition rate in Hz;
+          interval:    median time between transitions in s;
+          jitter:      standard deviation of that interval in s;
+          skipped:     frames that were stepped over, i.e. never observed;
+          repeated:    extra frame periods for which a frame was held, i.e.
+                       transitions missing when judged by the median interval;
+          overwritten: records lost to ring-buffer wrap-around;
+          poll_rate:   achieved polling rate in Hz;
+          error:       the error that stopped sampling early, or None.
+        Skipped frames are only meaningful if the polling rate is well above
+        the frame rate.
+        """
+        data = self.get_timeline()
+        with self.lock:
+            polls = self.polls
+            overwritten = max(0, self.count - len(self.buffer))
+            error = self.error
+            if self.start_time is None:
+                elapsed = 0.
+            elif self.run_flag or self.stop_time is None:
+                elapsed = timer() - self.start_time
+            else:
+                elapsed = self.stop_time - self.start_time
+        stats = {'transitions': max(0, len(data) - 1),
+                 'frame_rate': 0.,
+                 'interval': 0.,
+                 'jitter': 0.,
+                 'skipped': 0,
+                 'repeated': 0,
+                 'overwritten': overwritten,
+                 'error': error,
+                 'poll_rate': polls / elapsed if elapsed > 0 else 0.}
+        if len(data) < 3:
+            return stats
+        # Ignore the first record: it marks the start of sampling, not a
+        # transition.
+        times = data['time'][1:]
+        indices = data['index'][1:].astype(numpy.int64)
+        intervals = numpy.diff(times)
+        median = numpy.median(intervals)
+        n = sequence_length or (indices.max() + 1)
+        steps = numpy.diff(indices) % n
+        stats['frame_rate'] = len(intervals) / (times[-1] - times[0])
+        stats['interval'] = median
+        stats['jitter'] = intervals.std()
+        stats['skipped'] = int(numpy.maximum(steps - 1, 0).sum())
+        if median > 0:
+            held = numpy.rint(intervals / median).astype(numpy.int64)
+            stats['repeated'] = int(numpy.maximum(held - 1, 0).sum())
+        return stats
@@ -0,0 +1,162 @@
+""" Frame transfer through named shared memory for co-located clients.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+A client on the SLM host creates a segment, writes frames into its array and
+passes only the descriptor (name, shape, dtype) to the service, which
+attaches, uses the frames and detaches before returning:
+
+    with SharedFrames.create((n, 512, 512)) as frames:
+        frames.array[:] = patterns
+        slm.set_shared_sequence(wavelengths, *frames.descriptor)
+
+The creator owns the segment and removes it on close; the service never
+keeps a reference to it beyond the call, and attaches read-only. Names come
+from clients, so only names of the form PREFIX + letters, digits, '-' and '_'
+are accepted.
+On Windows, segments are named file mappings, which vanish when the last
+handle is closed. Elsewhere, they are files in /dev/shm (or the temporary
+directory) that the creator unlinks.
+"""
+
+import mmap
+import os
+import re
+import struct
+import tempfile
+import uuid
+import numpy
+
+## Segments start with a header so that attaching to a name that does not
+# exist is detected: on Windows, that would silently create a new segment.
+MAGIC = b'SLMFRAME'
+HEADER = struct.Struct('<8sQ')
+## Segment names: a fixed prefix, then no separators or dots, so that a name
+# can't refer to anything outside SHM_DIR.
+PREFIX = 'slmframes-'
+NAME_PATTERN = re.compile(r'^%s[A-Za-z0-9_-]+$' % re.escape(PREFIX))
+
+if os.path.isdir('/dev/shm'):
+    SHM_DIR = '/dev/shm'
+else:
+    SHM_DIR = tempfile.gettempdir()
+
+
+def check_name(name):
+    """ Raise an exception unless name is a valid segment name. """
+    if (not isinstance(name, basestring) or not NAME_PATTERN.match(name)
+            or os.sep in name or (os.altsep and os.altsep in name)
+            or '..' in name):
+        raise Exception("Invalid shared frames name %r." % (name,))
+
+
+class SharedFrames(object):
+    """ An array of frames in a named shared-memory segment.
+
+    The creator maps the segment read-write; those that attach map it
+    read-only, so array is read-only for them.
+    """
+    def __init__(self, name, shape, dtype=numpy.uint16, create=False):
+        check_name(name)
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.owner = create
+        nbytes = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        size = HEADER.size + nbytes
+        if os.name == 'nt':
+            self.mmap = mmap.mmap(-1, size, tagname=name)
+        else:
+            path = os.path.join(SHM_DIR, name)
+            if create:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+                os.ftruncate(fd, size)
+                access = mmap.ACCESS_WRITE
+            else:
+                # Not through a link, which could lead out of SHM_DIR.
+                fd = os.open(path, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0))
+                access = mmap.ACCESS_READ
+            try:
+                if os.fstat(fd).st_size < size:
+                    raise Exception("Shared frames %s are smaller than "
+                                    "%s %s." % (name, self.shape, self.dtype))
+                self.mmap = mmap.mmap(fd, size, access=access)
+            finally:
+                os.close(fd)
+        if create:
+            self.mmap[:HEADER.size] = HEADER.pack(MAGIC, nbytes)
+        else:
+            magic, length = HEADER.unpack(self.mmap[:HEADER.size])
+            if magic != MAGIC or length != nbytes:
+                self.mmap.close()
+                raise Exception("No shared frames %s of %s %s."
+                                % (name, self.shape, self.dtype))
+        self.array = numpy.ndarray(self.shape, self.dtype,
+                                   buffer=self.mmap, offset=HEADER.size)
+        if not create:
+            self.array.flags.writeable = False
+
+
+    @classmethod
+    def create(cls, shape, dtype=numpy.uint16, name=None):
+        """ Create a new segment, with a unique name unless one is given.
+
+        A name given must start with PREFIX; see check_name.
+        """
+        name = name or PREFIX + uuid.uuid4().hex
+        return cls(name, shape, dtype, create=True)
+
+
+    @classmethod
+    def attach(cls, name, shape, dtype=numpy.uint16):
+        """ Attach to an existing segment. """
+        return cls(name, shape, dtype, create=False)
+
+
+    @property
+    def descriptor(self):
+        """ (name, shape, dtype): all a peer needs to attach. """
+        return (self.name, self.shape, self.dtype.str)
+
+
+    def close(self):
+        """ Detach; the creator also removes the segment.
+
+        Any views of array must be released first: they refer directly to
+        the shared memory.
+        """
+        if self.mmap is None:
+            return
+        self.array = None
+        self.mmap.close()
+        self.mmap = None
+        if self.owner and os.name != 'nt':
+            try:
+                os.remove(os.path.join(SHM_DIR, self.name))
+            except OSError:
+                pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def __del__(self):
+        if getattr(self, 'mmap', None) is not None:
+            self.close()
@@ -0,0 +1,98 @@
+""" Tests of sequence sampling and streaming against the simulated DLL.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Needs no hardware: run with
+    python simtest.py
+"""
+
+import bnsdevice
+import bnssim
+import numpy as np
+from framestream import FrameStreamer
+from seqsampler import SequenceSampler
+from time import sleep
+
+## Sequencing rate, and the tolerance on the rate measured, in Hz.
+FRAME_RATE = 200.
+RATE_TOLERANCE = 0.05 * FRAME_RATE
+## Number of frames to stream.
+STREAM_FRAMES = 40
+## Slots a streamer may lose to the OS scheduler.
+MAX_SKIPPED = 2
+
+
+lib = bnssim.SimulatedLibrary(1, transferRate=0)
+dev = bnsdevice.open_boards(lib)[0]
+images = [np.full(dev.size * dev.size, n * 4096, dtype=np.uint16)
+          for n in range(4)]
+
+
+# Sample a running sequence and check the frame rate found.
+print "Sampling a sequence at %g Hz." % FRAME_RATE
+dev.load_sequence(images)
+dev.set_sequencing_framrate(FRAME_RATE)
+dev.start_sequence()
+sampler = SequenceSampler(dev, rate=2000.)
+sampler.start()
+sleep(1)
+assert sampler.stop() is None
+dev.stop_sequence()
+stats = sampler.get_statistics(len(images))
+print "  %s" % stats
+assert abs(stats['frame_rate'] - FRAME_RATE) < RATE_TOLERANCE
+assert stats['transitions'] > 0.9 * FRAME_RATE
+## An occasional late poll may miss a frame.
+assert stats['skipped'] < 0.02 * stats['transitions']
+assert stats['error'] is None
+
+
+# Stream frames queued up front: each should be written, none late.
+print "Streaming %d queued frames at %g Hz." % (STREAM_FRAMES, FRAME_RATE)
+frames = [images[n % len(images)] for n in range(STREAM_FRAMES)]
+streamer = FrameStreamer(dev, FRAME_RATE, prefetch=STREAM_FRAMES + 1,
+                         source=frames)
+streamer.start()
+assert streamer.wait(10 * STREAM_FRAMES / FRAME_RATE)
+streamer.stop()
+stats = streamer.get_statistics()
+print "  %s" % stats
+assert stats['frames'] == STREAM_FRAMES
+assert stats['underruns'] == 0
+assert stats['skipped'] <= MAX_SKIPPED
+assert abs(stats['rate'] - FRAME_RATE) < RATE_TOLERANCE
+
+
+# Stream with a gap in the frames pushed: the gap's slots are underruns.
+gap = 0.1
+print "Streaming with a %g s gap." % gap
+streamer = FrameStreamer(dev, FRAME_RATE)
+half = STREAM_FRAMES // 2
+for frame in frames[:half]:
+    streamer.put(frame)
+streamer.start()
+sleep(half / FRAME_RATE + gap)
+for frame in frames[half:]:
+    streamer.put(frame)
+streamer.finish()
+assert streamer.wait(10 * STREAM_FRAMES / FRAME_RATE)
+streamer.stop()
+stats = streamer.get_statistics()
+print "  %s" % stats
+assert stats['frames'] == STREAM_FRAMES
+assert abs(stats['underruns'] - gap * FRAME_RATE) <= 0.25 * gap * FRAME_RATE
+assert stats['skipped'] <= MAX_SKIPPED
+
+print "All tests passed."
@@ -0,0 +1,264 @@
+""" Client-side access to a SpatialLightModulator served by slmservice.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+SLMClient keeps one connection to the service for all of its users, and
+answers repeated queries for values that rarely change from a local cache.
+Any method of the service can be called on the client:
+    slm = SLMClient()
+    shape = slm.get_shape()        # one round trip, then cached
+    slm.set_custom_sequence(488, patterns)
+    with slm.batch() as batch:     # one round trip for both calls
+        batch.set_sim_diffraction_angle(0.3)
+        batch.run()
+"""
+
+import socket
+from itertools import islice
+import threading
+import numpy
+import Pyro4
+from sharedframes import SharedFrames
+
+## Numpy arrays are sent to the service by pickle; set per proxy, so that
+# other proxies in the process keep their own serializer.
+SERIALIZER = 'pickle'
+
+CONFIG_NAME = 'slm'
+## Patterns sent per call when uploading in chunks.
+CHUNK = 8
+
+## Cached queries, and the calls that invalidate each of them.
+CACHED = {'get_shape': (),
+          'get_board': (),
+          'get_sim_diffraction_angle': ('set_sim_diffraction_angle',),
+          'get_zernike_modes': ('set_zernike_order',),
+          'get_aberration': ('set_aberration', 'set_zernike_order'),
+          'get_frame_timing': ('set_true_frames', 'set_sequencing_framerate',
+                               'plan_frame_rate'),
+          'get_roi': ('set_roi', 'set_pupil'),
+          }
+
+## Map of call to the cached queries it invalidates.
+INVALIDATES = {}
+for _query, _setters in CACHED.items():
+    for _setter in _setters:
+        INVALIDATES.setdefault(_setter, []).append(_query)
+
+
+def is_query(method):
+    """ Return True if method only reads, so is safe to call again. """
+    return method in CACHED or method.startswith('get_')
+
+
+def is_local(host):
+    """ Return True if host is this machine. """
+    try:
+        address = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    if address.startswith('127.'):
+        return True
+    try:
+        return address in socket.gethostbyname_ex(socket.gethostname())[2]
+    except socket.error:
+        return False
+
+
+class SLMClient(object):
+    """ A persistent, thread-safe connection to an SLM service.
+
+    host and port default to those in slmservice.conf; name is the Pyro
+    object, e.g. pyroSLM1 for a second board. Calls from several threads
+    share the connection and are made one at a time. A query that fails
+    because the connection was lost is retried once on a new connection;
+    other calls may already have been made by the service, so they are not.
+    """
+    def __init__(self, host=None, port=None, name='pyroSLM'):
+        if host is None or port is None:
+            import readconfig
+            config = readconfig.config
+            host = host or config.get(CONFIG_NAME, 'ipAddress')
+            port = port or config.getint(CONFIG_NAME, 'port')
+        self.uri = 'PYRO:%s@%s:%d' % (name, host, port)
+        ## Whether patterns can be passed through shared memory.
+        self.local = is_local(host)
+        self.lock = threading.RLock()
+        self._proxy = None
+        # Results of cached queries, by method name.
+        self._cache = {}
+
+
+    def _get_proxy(self):
+        if self._proxy is None:
+            self._proxy = Pyro4.Proxy(self.uri)
+            self._proxy._pyroSerializer = SERIALIZER
+        return self._proxy
+
+
+    def close(self):
+        """ Release the connection; the next call opens a new one. """
+        with self.lock:
+            if self._proxy is not None:
+                self._proxy._pyroRelease()
+                self._proxy = None
+            self._cache.clear()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def invalidate(self, *queries):
+        """ Discard cached results of queries, or of all queries. """
+        with self.lock:
+            if queries:
+                for query in queries:
+                    self._cache.pop(query, None)
+            else:
+                self._cache.clear()
+
+
+    def call(self, method, *args, **kwargs):
+        """ Call method on the service, or return its cached result. """
+        with self.lock:
+            if method in CACHED and method in self._cache:
+                return self._cache[method]
+            try:
+                result = getattr(self._get_proxy(), method)(*args, **kwargs)
+            except Pyro4.errors.CommunicationError:
+                # The service may have restarted: cached values are stale.
+                self.close()
+                if not is_query(method):
+                    raise
+                result = getattr(self._get_proxy(), method)(*args, **kwargs)
+            self.invalidate(*INVALIDATES.get(method, ()))
+            if method in CACHED:
+                self._cache[method] = result
+            return result
+
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def remote(*args, **kwargs):
+            return self.call(method, *args, **kwargs)
+        remote.__name__ = method
+        return remote
+
+
+    def set_custom_sequence(self, wavelengths, patterns, count=None,
+                            chunk=CHUNK):
+        """ As SpatialLightModulator.set_custom_sequence.
+
+        When the service is on this host, the patterns are passed through
+        shared memory rather than sent over the connection. Iterators, e.g.
+        generators, are sent chunk patterns at a time, so that neither end
+        holds more than one copy of the sequence, given count if patterns
+        has no len(); otherwise they are collected first.
+        """
+        if not hasattr(patterns, '__getitem__'):
+            return self.upload_custom_sequence(wavelengths, patterns, count,
+                                               chunk)
+        if not self.local:
+            return self.call('set_custom_sequence', wavelengths, patterns)
+        # Patterns keep their shape: they may be ROI pixels only.
+        patterns = numpy.asarray(patterns, dtype=numpy.uint16)
+        with SharedFrames.create(patterns.shape) as frames:
+            frames.array[...] = patterns
+            return self.call('set_shared_sequence', wavelengths,
+                             *frames.descriptor)
+
+
+    def upload_custom_sequence(self, wavelengths, patterns, count=None,
+                               chunk=CHUNK):
+        """ Send patterns to the service chunk at a time, then load them. """
+        if count is None:
+            if not hasattr(patterns, '__len__'):
+                patterns = list(patterns)
+            count = len(patterns)
+        with self.lock:
+            token = self.call('begin_custom_sequence', wavelengths, count)
+            try:
+                patterns = iter(patterns)
+                while True:
+                    patterns16 = [numpy.asarray(p, dtype=numpy.uint16)
+                                  for p in islice(patterns, chunk)]
+                    if not patterns16:
+                        break
+                    self.call('add_custom_patterns', token, patterns16)
+            except:
+                # Release the service's buffer, if it can still be reached.
+                try:
+                    self.call('cancel_custom_sequence', token)
+                except Pyro4.errors.PyroError:
+                    pass
+                raise
+            return self.call('end_custom_sequence', token)
+
+
+    def batch(self):
+        """ Return a Batch that makes the calls given to it in one trip. """
+        return Batch(self)
+
+
+class Batch(object):
+    """ Calls collected to be made together by execute_batch.
+
+    Methods called on a Batch are recorded, and made on the service, in
+    order and under its lock, by execute() or on leaving a with block.
+    execute() returns the list of results, and raises the exception of a
+    call that failed, after which no further calls are made.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.results = None
+
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def record(*args, **kwargs):
+            self.calls.append((method, args, kwargs))
+        record.__name__ = method
+        return record
+
+
+    def execute(self):
+        calls, self.calls = self.calls, []
+        client = self.client
+        with client.lock:
+            results, error = client.call('execute_batch', calls)
+            # Calls that were made may have changed cached values.
+            for method, args, kwargs in calls[:len(results) + 1]:
+                client.invalidate(*INVALIDATES.get(method, ()))
+        self.results = results
+        if error is not None:
+            raise error[1]
+        return results
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
@@ -15,20 +15,44 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-from bnsdevice import BNSDevice
-from itertools import chain, product
+import bnsdevice
+from bnsdevice import BNSDevice, BoardGroup
+from seqsampler import SequenceSampler
+import tiffstack
+from sharedframes import SharedFrames
+from framestream import FrameStreamer
+from framesequence import FrameSequence, content_key
+import parallel
+import kernels
+import zernike
+from hologram import GerchbergSaxton
+from profiling import CallProfiler
+from collections import OrderedDict
+from itertools import chain, izip, product, repeat
 import logging
-import socket, threading
+import ctypes, socket, threading
 import os, re, numpy
 import Pyro4
 from PIL import Image
 from numpy import arange, cos, sin, pi, rint, meshgrid, zeros, amax, amin
+from functools import wraps
 from time import sleep
+from timeit import default_timer as timer
 
 CONFIG_NAME = 'slm'
 LOG_FORMAT = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
 LOG_DATE_FORMAT = '%m-%d %H:%M'
+## Default memory budget for stored sequences, in bytes.
+LIBRARY_BUDGET = 1 << 30
 TWO_PI = 2. * pi
+## Chunked uploads: how long one may go without a call before it is
+# discarded, in s, and how many may be open at once.
+UPLOAD_TIMEOUT = 300.
+MAX_UPLOADS = 8
+## Methods that execute_batch refuses: they wait on threads that need the
+# hardware lock, which a batch holds throughout, or take other locks.
+UNBATCHED = ('execute_batch', 'push_stream', 'end_stream', 'start_sampler',
+             'stop_sampler', 'reconnect')
 
 #Pyro4.config.SERIALIZERS_ACCEPTED.remove('serpent')
 Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
@@ -42,12 +66,24 @@ logging.basicConfig(level=logging.INFO,
                     filemode='w')
 
 
+def locked(func):
+    """ Decorator: hold the instance's hardware lock for the call. """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
 @Pyro4.expose
 class SpatialLightModulator(object):
-    def __init__(self):
+    def __init__(self, hardware=None):
         # Logging
         loggerName = '.'.join([__name__, self.__class__.__name__])
         self.logger = logging.getLogger(loggerName)
+        # Serializes access to the hardware and sequence state. Re-entrant,
+        # so that locked methods can call each other.
+        self.lock = threading.RLock()
         ## SLM geometry
         # Physical pitch in microns
         self.pixel_pitch = 15.0
@@ -57,8 +93,8 @@ class SpatialLightModulator(object):
         x_range = arange(self.pixels[0])
         y_range = arange(self.pixels[1])
         self.kk, self.ll = meshgrid(x_range, y_range)
-        ## Image sequence
-        self.sequence = []
+        ## Image sequence: unique frames and the order to show them in.
+        self.sequence = FrameSequence()
         self.sequence_parameters = []
         ## SIM parameters
         self.sim_phase_offset = 0
@@ -66,6 +102,46 @@ class SpatialLightModulator(object):
         self.sim_num_phases = 5
         self.sim_num_angles = 3
         self.sim_diffraction_angle = 0.35 # degrees was 0.5 then .25  
+        ## Aberration correction
+        # Highest radial order of the Zernike basis.
+        self.zernike_order = 4
+        # Pupil radius in microns; None for the circle inscribed in the SLM.
+        self.pupil_radius = None
+        # Cached basis and the geometry it was evaluated for.
+        self._zernike_basis = None
+        self._zernike_geometry = None
+        # Correction added to generated gratings, in waves and as 16-bit 
+        # phase.
+        self.aberration = None
+        self._aberration16 = None
+        ## Region of interest: flat indices of the pixels to evaluate, or
+        # None for all of them. Other pixels are taken from the background,
+        # a 16-bit frame, which is cached LUT-mapped by wavelength.
+        self.roi = None
+        self.background = None
+        self._backgrounds = {}
+        ## Custom sequences being received in chunks, by token:
+        # [wavelengths, builder, time of last call]; and the last token
+        # issued.
+        self._uploads = {}
+        self._last_upload = 0
+        ## Hologram engine, created on first use.
+        self._hologram = None
+        ## Sequencing rate (Hz) and true frames, as last set; None until set.
+        self.frame_rate = None
+        self.true_frames = None
+        ## Stored sequences, ready to upload, by name, least recently used
+        # first: (sequence, parameters, contiguous buffer).
+        self.library = OrderedDict()
+        self.library_budget = LIBRARY_BUDGET
+        ## Digest of the sequence on the board, if known, and counts of
+        # uploads made and of those skipped because it was unchanged.
+        self.loaded_digest = None
+        self.uploads = 0
+        self.uploads_skipped = 0
+        ## Profiler and the methods it wraps, while profiling.
+        self.profiler = None
+        self._profiled = []
         ## Look-up tables and calibration data
         # Paths
         self._LUTFolder = "LUT_files"
@@ -75,20 +151,32 @@ class SpatialLightModulator(object):
         self.calibs = {}
         # Load calib. data and LUT files
         self.load_calibration_data()
-        ## Connect to the hardware.
-        self.hardware = BNSDevice()     
-        ## Initialize the hardware.
-        self.hardware.initialize()
+        if hardware is None:
+            ## Connect to the hardware.
+            self.hardware = BNSDevice()     
+            ## Initialize the hardware.
+            self.hardware.initialize()
+        else:
+            # An initialized device, e.g. one of several from open_boards.
+            self.hardware = hardware
+        ## Sequence position sampler, created on demand.
+        self.sampler = None
+        ## Software frame streamer, while streaming.
+        self.streamer = None
+        ## Services for boards on the same library, including this one;
+        # linked by SpatialLightModulatorGroup.
+        self.peers = [self]
 
 
     def get_sequence(self):
-        return self.sequence
+        return self.sequence.expand()
 
 
     def get_sim_sequence(self):
         return self.sequence_parameters
 
 
+    @locked
     def set_sim_sequence(self, angle_phase_wavelength):
         """ Generate a SIM sequence from a list of parameters.
 
@@ -119,23 +207,37 @@ class SpatialLightModulator(object):
 
         # retardation for equal powers in 0 and combined +/-1 orders
         modulation = 65535 * 150. / 360.0
-
-        sequence = []
-        for (angle, phase, wavelength) in angle_phase_wavelength:
+        # Aberration correction, if any, to add to each grating.
+        aberration16 = self._aberration16
+        # Pixel indices, and correction, where gratings are evaluated.
+        kk, ll = self.kk, self.ll
+        if self.roi is not None:
+            kk, ll = kk.flat[self.roi], ll.flat[self.roi]
+            if aberration16 is not None:
+                aberration16 = aberration16.flat[self.roi]
+
+        def make_tile(params, rows):
+            angle, phase, wavelength = params
             pp = pitches[wavelength] / self.pixel_pitch
             th = angles[angle]
             ph = phases[phase]
             # Create a stripe 16-bit pattern
-            pattern16 = numpy.ushort(
-                rint(
-                    (0.5 * modulation) + (0.5 * modulation) * cos(
-                        ph + TWO_PI * (cos(th) * self.kk + sin(th) * self.ll)
-                        / pp)
-                    ))              
+            pattern16 = kernels.grating(kk[rows], ll[rows],
+                                        cos(th), sin(th), pp, ph,
+                                        0.5 * modulation, 0.5 * modulation)
+            if aberration16 is not None:
+                # Phases add, wrapping on the 16-bit range.
+                pattern16 += aberration16[rows]
             # Lose two LSBs and pass through the LUT for given wavelength.
-            pattern = luts[wavelength][pattern16 / 4]
-            # Append to the sequence.
-            sequence.append(pattern)
+            return kernels.lut_map(luts[wavelength], pattern16)
+
+        def render(unique):
+            return self._render_frames([w for (a, p, w) in unique],
+                lambda n, rows: make_tile(unique[n], rows))
+
+        # Each distinct (angle, phase, wavelength) is generated only once.
+        sequence = FrameSequence.from_keys(
+            [tuple(params) for params in angle_phase_wavelength], render)
         self.sequence_parameters = angle_phase_wavelength
         self.sequence = sequence
         self.load_sequence()
@@ -148,7 +250,7 @@ class SpatialLightModulator(object):
             implot = plt.imshow(im)
             implot.set_cmap('gray')
             plt.savefig(fn)
-        return (amin(self.sequence), amax(self.sequence))
+        return (amin(self.sequence.frames), amax(self.sequence.frames))
 
 
     def get_lut(self, wavelength):
@@ -235,25 +337,167 @@ class SpatialLightModulator(object):
         return None
 
 
-    def load_sequence(self):
-        """ Loads images to the device. """
+    @locked
+    def load_sequence(self, force=False):
+        """ Loads images to the device.
+
+        The upload is skipped if the board already holds the same frames,
+        unless force is set.
+        """
         if not self.sequence:
             raise Exception(
                 'No data to load to SLM --- generate sequence then load.')
+        digest = self.sequence.digest()
+        if digest == self.loaded_digest and not force:
+            self.uploads_skipped += 1
+            self.logger.debug('Sequence unchanged: upload skipped.')
+            return None
+        # Unknown until the upload has succeeded.
+        self.loaded_digest = None
+        if self.sequence.buffer is not None:
+            # Built in place, ready to upload.
+            self.hardware.load_sequence_buffer(self.sequence.buffer)
         else:
-            self.hardware.load_sequence(self.sequence)
+            # Repeated frames are expanded only here, as references.
+            self.hardware.load_sequence(self.sequence.expand())
+        self.loaded_digest = digest
+        self.uploads += 1
         return None
 
 
+    def get_upload_counts(self):
+        """ Return (uploads made, uploads skipped as unchanged). """
+        return (self.uploads, self.uploads_skipped)
+
+
+    def reconnect(self):
+        """ Re-open the boards after a fault, and restore their state.
+
+        Re-opening resets every board on the library, so all of them are
+        restored: the LUT, calibration, frame timing and sequence last sent
+        to each are replayed from buffers that are already converted, and
+        no pattern is regenerated. Every peer service is locked meanwhile,
+        and any stream stopped. Returns a dict of the recovery time, the
+        time taken by sequence uploads and that by board, in s.
+        """
+        # Locked in board order, so that concurrent reconnects can't
+        # deadlock.
+        slms = sorted(self.peers, key=lambda slm: slm.hardware.board)
+        for slm in slms:
+            slm.lock.acquire()
+        try:
+            digests = {}
+            for slm in slms:
+                if slm.streamer is not None:
+                    slm.stop_stream()
+                # Unknown until the board has been restored.
+                digests[slm] = slm.loaded_digest
+                slm.loaded_digest = None
+            recovery_time, upload_times = self.hardware.reconnect()
+            # Each board holds its last sequence again.
+            for slm in slms:
+                slm.loaded_digest = digests[slm]
+        finally:
+            for slm in reversed(slms):
+                slm.lock.release()
+        upload_time = sum(upload_times.values())
+        self.logger.info('Reconnected in %.3f s (%.3f s for uploads).'
+                         % (recovery_time, upload_time))
+        return {'recovery_time': recovery_time, 'upload_time': upload_time,
+                'upload_times': upload_times}
+
+
+    @locked
+    def store_sequence(self, name):
+        """ Keep the current sequence, ready to upload, as name.
+
+        Least recently used sequences are discarded to keep the library
+        within library_budget bytes. Returns the size of the stored buffer.
+        """
+        if not self.sequence:
+            raise Exception('No sequence to store --- generate one first.')
+        if len(self.sequence) < 2:
+            raise Exception('Only sequences of two or more images can be '
+                            'stored - this one has %d.' % len(self.sequence))
+        buffer = self.sequence.buffer
+        if buffer is None:
+            buffer = self.hardware.make_sequence_buffer(
+                self.sequence.expand())
+        nbytes = ctypes.sizeof(buffer)
+        if nbytes > self.library_budget:
+            raise Exception('Sequence of %d bytes exceeds the library '
+                            'budget of %d bytes.' 
+                            % (nbytes, self.library_budget))
+        # Replaced only now that the new one is known to fit; its old
+        # size counts as freed when trimming.
+        self.library.pop(name, None)
+        self._trim_library(self.library_budget - nbytes)
+        self.library[name] = (self.sequence, self.sequence_parameters, 
+                              buffer)
+        return nbytes
+
+
+    @locked
+    def activate_sequence(self, name):
+        """ Upload and start the stored sequence name. """
+        if name not in self.library:
+            raise Exception('No sequence %s in the library.' % name)
+        # Move to the most recently used end.
+        entry = self.library.pop(name)
+        self.library[name] = entry
+        self.sequence, self.sequence_parameters, buffer = entry
+        self.hardware.stop_sequence()
+        self.loaded_digest = None
+        self.hardware.load_sequence_buffer(buffer)
+        self.loaded_digest = self.sequence.digest()
+        self.uploads += 1
+        self.hardware.start_sequence()
+        return None
+
+
+    @locked
+    def remove_sequence(self, name):
+        """ Discard the stored sequence name. """
+        self.library.pop(name, None)
+
+
+    def get_library(self):
+        """ Return a dict of stored sequence names to (frames, bytes). """
+        return {name: (len(buffer), ctypes.sizeof(buffer))
+                for name, (_, _, buffer) in self.library.items()}
+
+
+    def get_library_usage(self):
+        """ Return the total size of stored sequences, in bytes. """
+        return sum(ctypes.sizeof(buffer) 
+                   for (_, _, buffer) in self.library.values())
+
+
+    @locked
+    def set_library_budget(self, nbytes):
+        """ Set the memory budget for stored sequences, in bytes. """
+        self.library_budget = int(nbytes)
+        self._trim_library(self.library_budget)
+
+
+    def _trim_library(self, nbytes):
+        """ Discard least recently used sequences until within nbytes. """
+        while self.library and self.get_library_usage() > nbytes:
+            old, _ = self.library.popitem(last=False)
+            self.logger.warning('Discarded sequence %s from the library.' 
+                                % old)
+
+
+    @locked
     def set_test_sequence(self):
         """ Generate a series of test images. """
         from PIL import Image, ImageDraw, ImageFont
-        sequence = []
+        sequence = FrameSequence()
         labels = range(15)
         lut = self.get_lut(550)
         imsize = self.pixels
         font = ImageFont.truetype('arial.ttf', imsize[0]/2)
-        for c in labels:
+        def make_pattern(c):
             image = Image.new('L', imsize)
             draw = ImageDraw.Draw(image)
             draw.setink(255)
@@ -261,9 +505,11 @@ class SpatialLightModulator(object):
             pattern16 = numpy.array(image.getdata(), 
                                     dtype=numpy.ushort).reshape(imsize)
             pattern16 *= (65535 * 123.9 / 360) / pattern16.max()
-            pattern = lut[pattern16 / 4]
-            # Append to the sequence.
-            sequence.append(pattern)
+            return kernels.lut_map(lut, pattern16)
+
+        for c in labels:
+            # Each distinct label is drawn only once.
+            sequence.add(c, lambda: make_pattern(c))
         self.sequence_parameters = map(lambda x: (x, 0, 0), labels)
         self.sequence = sequence
         self.load_sequence()
@@ -273,7 +519,13 @@ class SpatialLightModulator(object):
         return self.pixels
 
 
-    def set_custom_sequence(self, wavelengths, patterns):
+    def get_board(self):
+        """ Return the index of the board this instance drives. """
+        return self.hardware.board
+
+
+    @locked
+    def set_custom_sequence(self, wavelengths, patterns, count=None):
         """ Generate sequence from given wavelengths and patterns.
 
         Accepts:
@@ -282,27 +534,272 @@ class SpatialLightModulator(object):
 
         Patterns should be arrays of 16-bit unsigned integers; they will be
         reshaped to the device size, which can be queried with get_shape().
+        Patterns that are repeated at the same wavelength are LUT-mapped 
+        and stored once.
+        patterns may be any iterable, e.g. a generator. Each pattern is
+        mapped straight into the buffer that is uploaded, so only one copy
+        of the sequence is held, as long as count gives the number of
+        patterns when it has no len(); otherwise they are collected first.
+        """
+        # Generate the sequence.
+        self.sequence = self._make_custom_sequence(wavelengths, patterns, 
+                                                   count)
+        # Load sequence to the hardware.
+        self.load_sequence()
+
+
+    @locked
+    def begin_custom_sequence(self, wavelengths, count):
+        """ Start a custom sequence of count patterns sent in chunks.
+
+        wavelengths is as for set_custom_sequence. Returns a token for the
+        upload: send the patterns, in order, with add_custom_patterns, then
+        call end_custom_sequence to load them, or cancel_custom_sequence.
+        Each chunk is mapped straight into the upload buffer; uploads from
+        different clients are kept apart by their tokens. Uploads with no
+        call for UPLOAD_TIMEOUT s are discarded, and at most MAX_UPLOADS may
+        be open at once.
         """
         if type(wavelengths) in [list, tuple]:
-            assert len(wavelengths) == len(patterns), \
+            assert len(wavelengths) == count, \
+                "len(wavelengths) != count."
+        now = timer()
+        for token, upload in self._uploads.items():
+            if now - upload[2] > UPLOAD_TIMEOUT:
+                self.logger.warning('Discarded custom sequence %s: no call '
+                                    'for %d s.' % (token, now - upload[2]))
+                del self._uploads[token]
+        if len(self._uploads) >= MAX_UPLOADS:
+            raise Exception('Too many custom sequences open (%d) --- end or '
+                            'cancel one first.' % len(self._uploads))
+        self._last_upload += 1
+        token = self._last_upload
+        self._uploads[token] = [wavelengths,
+                                self._new_sequence_builder(count), now]
+        return token
+
+
+    def _get_upload(self, token):
+        """ Return (wavelengths, builder) for token, marking it in use. """
+        if token not in self._uploads:
+            raise Exception('No custom sequence %s started ---'
+                            ' call begin_custom_sequence first.' % token)
+        upload = self._uploads[token]
+        upload[2] = timer()
+        return upload[:2]
+
+
+    @locked
+    def add_custom_patterns(self, token, patterns):
+        """ Add a chunk of patterns to the sequence being sent as token.
+
+        Returns the number of patterns received so far.
+        """
+        wavelengths, builder = self._get_upload(token)
+        if type(wavelengths) in [list, tuple]:
+            n = len(builder.sequence)
+            wavelengths = wavelengths[n:n + len(patterns)]
+        self._add_custom_patterns(builder, wavelengths, patterns)
+        return len(builder.sequence)
+
+
+    @locked
+    def end_custom_sequence(self, token):
+        """ Load the custom sequence sent as token. """
+        wavelengths, builder = self._get_upload(token)
+        del self._uploads[token]
+        self.sequence = builder.finish()
+        self.load_sequence()
+
+
+    @locked
+    def cancel_custom_sequence(self, token):
+        """ Discard the custom sequence being sent as token, if any. """
+        self._uploads.pop(token, None)
+
+
+    def _make_custom_sequence(self, wavelengths, patterns, count=None):
+        """ Return a FrameSequence of LUT-mapped patterns. """
+        if count is None:
+            if not hasattr(patterns, '__len__'):
+                # Without a count, collect them first.
+                patterns = list(patterns)
+            count = len(patterns)
+        if type(wavelengths) in [list, tuple]:
+            assert len(wavelengths) == count, \
                 "len(wavelengths) != len(patterns)."
-        else:
-            wavelengths = len(patterns) * [wavelengths]
+        builder = self._new_sequence_builder(count)
+        self._add_custom_patterns(builder, wavelengths, patterns)
+        return builder.finish()
+
+
+    def _new_sequence_builder(self, count):
+        """ Return a SequenceBuilder that writes into a new upload buffer. """
+        buffer, frames = self.hardware.new_sequence_buffer(count)
+        return FrameSequence.builder(frames, buffer)
+
+
+    def _add_custom_patterns(self, builder, wavelengths, patterns):
+        """ Map patterns through their LUTs and add them to builder. """
+        for (w, lut, pattern16) in self._cast_patterns(wavelengths, patterns):
+            # Lose two LSBs and pass through the LUT for given wavelength.
+            def make_tile(n, rows):
+                return kernels.lut_map(lut, pattern16[rows])
+            # Patterns that repeat are identified by content.
+            builder.add(content_key(w, pattern16), 
+                        lambda out: self._render_frames(
+                            [w], make_tile, out[numpy.newaxis]))
+
+
+    def _cast_patterns(self, wavelengths, patterns):
+        """ Yield (wavelength, LUT, 16-bit pattern) for each pattern.
+
+        wavelengths is a single wavelength, or one for each pattern.
+        patterns may be any iterable; they are consumed one at a time.
+        """
+        if type(wavelengths) not in [list, tuple]:
+            wavelengths = repeat(wavelengths)
         # Determine LUT once for each wavelength.
-        luts = {w: self.get_lut(w) for w in set(wavelengths)}
-        # Generate the sequence.
-        self.sequence = []
-        for (w, p) in zip(wavelengths, patterns):
+        luts = {}
+        for (w, p) in izip(wavelengths, patterns):
+            if w not in luts:
+                luts[w] = self.get_lut(w)
             # Cast and reshape provided pattern.
-            pattern16 = numpy.array(p, dtype=numpy.ushort).reshape(self.pixels)
+            pattern16 = numpy.ascontiguousarray(p, dtype=numpy.ushort)
+            if self.roi is None:
+                pattern16 = pattern16.reshape(self.pixels)
+            else:
+                # Keep ROI pixels, as a vector; patterns may be given as
+                # just those pixels, in the order of get_roi().
+                pattern16 = pattern16.reshape(-1)
+                if pattern16.size != self.roi.size:
+                    pattern16 = pattern16[self.roi]
+            yield w, luts[w], pattern16
+
+
+    def _map_patterns(self, wavelengths, patterns):
+        """ Yield patterns passed through the LUT for their wavelengths. """
+        for (w, lut, pattern16) in self._cast_patterns(wavelengths, patterns):
             # Lose two LSBs and pass through the LUT for given wavelength.
-            pattern = luts[w][pattern16 / 4]
-            # Append to the sequence.
-            self.sequence.append(pattern)
-        # Load sequence to the hardware.
-        self.load_sequence()
+            frame = kernels.lut_map(lut, pattern16)
+            if self.roi is not None:
+                frame = self._fill_roi(frame[numpy.newaxis], [w])[0]
+            yield frame
+
+
+    def _render_frames(self, wavelengths, kernel, out=None):
+        """ Render frames at wavelengths with kernel, as render_frames.
+
+        With an ROI, kernel is given slices of the ROI's pixels, and the
+        rest of each frame is filled from the background.
+        """
+        if self.roi is None:
+            return parallel.render_frames(len(wavelengths), self.pixels, 
+                                          kernel, out=out)
+        values = parallel.render_frames(
+            len(wavelengths), self.roi.shape, kernel, 
+            tile_rows=parallel.TILE_ROWS * self.pixels[1])
+        return self._fill_roi(values, wavelengths, out)
 
 
+    def _fill_roi(self, values, wavelengths, out=None):
+        """ Return frames of LUT-mapped ROI values over the background.
+
+        Frames are written to out, if given.
+        """
+        backgrounds = []
+        for w in wavelengths:
+            if w not in self._backgrounds:
+                background = self.background
+                if background is None:
+                    background = numpy.zeros(self.pixels, numpy.ushort)
+                self._backgrounds[w] = kernels.lut_map(self.get_lut(w), 
+                                                       background)
+            backgrounds.append(self._backgrounds[w])
+        if out is None:
+            out = numpy.array(backgrounds)
+        else:
+            out[...] = backgrounds
+        out.reshape((len(out), -1))[:, self.roi] = values
+        return out
+
+
+    @locked
+    def set_roi(self, mask=None, background=0):
+        """ Evaluate patterns only where mask is true.
+
+        mask is a boolean array of the device shape, or None to evaluate
+        every pixel. Pixels outside the mask show background: a 16-bit
+        value, or pattern of the device shape, passed through the LUT.
+        Custom patterns may then be sent as just the ROI pixels, in the
+        order given by get_roi(). Applies to sequences generated from now
+        on. Returns the number of pixels in the ROI.
+        """
+        self._backgrounds = {}
+        if mask is None:
+            self.roi = None
+            self.background = None
+            return int(numpy.prod(self.pixels))
+        mask = numpy.asarray(mask, dtype=bool).reshape(self.pixels)
+        self.roi = numpy.flatnonzero(mask)
+        self.background = numpy.empty(self.pixels, numpy.ushort)
+        self.background[...] = background
+        self.logger.info('ROI of %d pixels.' % self.roi.size)
+        return int(self.roi.size)
+
+
+    @locked
+    def set_pupil(self, radius=None, centre=None, background=0):
+        """ Set a circular ROI of radius (microns) about centre (pixels).
+
+        centre is (row, column), by default the middle of the device; with
+        no radius, the ROI is cleared. See set_roi.
+        """
+        if radius is None:
+            return self.set_roi(None)
+        if centre is None:
+            centre = ((self.pixels[0] - 1) / 2., (self.pixels[1] - 1) / 2.)
+        rows, cols = numpy.ogrid[0:self.pixels[0], 0:self.pixels[1]]
+        mask = (numpy.hypot(rows - centre[0], cols - centre[1]) 
+                <= radius / self.pixel_pitch)
+        return self.set_roi(mask, background)
+
+
+    def get_roi(self):
+        """ Return the flat indices of the pixels in the ROI, or None. """
+        return self.roi
+
+
+    @locked
+    def set_shared_sequence(self, wavelengths, name, shape, dtype='<u2'):
+        """ Generate sequence from patterns in shared memory on this host.
+
+        name, shape and dtype describe a segment created by the client with
+        sharedframes.SharedFrames; the patterns are read from it directly,
+        as for set_custom_sequence, and it is detached before returning.
+        """
+        frames = SharedFrames.attach(name, shape, dtype)
+        try:
+            # set_custom_sequence keeps only LUT-mapped copies, so nothing
+            # refers to the segment once it returns.
+            self.set_custom_sequence(wavelengths, frames.array)
+        finally:
+            frames.close()
+
+
+    @locked
+    def set_tiff_sequence(self, wavelengths, path):
+        """ Generate sequence from TIFF files on the SLM host.
+
+        path is a directory of TIFFs, a multi-page TIFF, or a list of files;
+        each page is one 16-bit pattern, as for set_custom_sequence.
+        """
+        patterns = tiffstack.load_stack(path, self.pixels)
+        self.set_custom_sequence(wavelengths, patterns)
+        return len(patterns)
+
+
+    @locked
     def run(self):
         """ Power on and make device respond to triggers. """
         self.hardware.power = True
@@ -310,6 +807,7 @@ class SpatialLightModulator(object):
         return None
 
 
+    @locked
     def stop(self):
         """ Power off and stop device responding to triggers. """
         self.hardware.stop_sequence()
@@ -317,18 +815,93 @@ class SpatialLightModulator(object):
         return None
 
 
+    @locked
+    def start_stream(self, rate, prefetch=32):
+        """ Start displaying streamed frames at rate Hz with write_image.
+
+        Stops any running sequence. Frames are queued with push_stream;
+        up to prefetch frames are held ready.
+        """
+        self.stop_stream()
+        self.hardware.stop_sequence()
+        # Don't rely on the board's sequence surviving direct writes.
+        self.loaded_digest = None
+        self.hardware.power = True
+        self.streamer = FrameStreamer(self.hardware, rate, prefetch,
+                                      hardwareLock=self.lock)
+        self.streamer.start()
+
+
+    def push_stream(self, wavelengths, patterns):
+        """ Queue patterns for streaming, as for set_custom_sequence.
+
+        Blocks while the prefetch queue is full, so a client can push
+        frames as fast as it likes. Not locked, so that other calls can be
+        made while it blocks.
+        """
+        streamer = self.streamer
+        if streamer is None:
+            raise Exception('Not streaming --- call start_stream first.')
+        for frame in self._map_patterns(wavelengths, patterns):
+            streamer.put(frame)
+        return streamer.queue.qsize()
+
+
+    def end_stream(self, timeout=None):
+        """ Stop streaming once queued frames have been shown. 
+
+        Returns the stream statistics, as for stop_stream.
+        """
+        streamer = self.streamer
+        if streamer is None:
+            return None
+        streamer.finish()
+        streamer.wait(timeout)
+        return self.stop_stream()
+
+
+    @locked
+    def stop_stream(self):
+        """ Stop streaming now; return frame timing statistics. """
+        if self.streamer is None:
+            return None
+        self.streamer.stop()
+        stats = self.streamer.get_statistics()
+        self.logger.info('Stream stopped: %s' % stats)
+        self.streamer = None
+        return stats
+
+
+    def get_stream_statistics(self):
+        """ Return frame timing statistics for the current stream. """
+        if self.streamer is None:
+            return None
+        return self.streamer.get_statistics()
+
+
+    def get_stream_timing(self):
+        """ Return per-frame (slot, scheduled, written, duration) records. """
+        if self.streamer is None:
+            return None
+        return self.streamer.get_timing()
+
+
+    @locked
     def get_temperature(self):
         return self.hardware.temperature
 
 
+    @locked
     def get_is_enabled(self):
         return self.hardware.power
 
 
+    @locked
     def get_power(self):
         return self.hardware.power
 
 
+    @locked
     def get_sequence_index(self):
         index = self.hardware.curr_seq_image
         # Index is actually that of the image that will be displayed
@@ -336,19 +909,389 @@ class SpatialLightModulator(object):
         return index - 1 if index > 0 else len(self.sequence) - 1
 
 
+    def start_sampler(self, rate=2000., size=65536):
+        """ Start recording a timeline of the sequence position.
+
+        The current sequence image is polled at rate Hz; index changes are
+        kept in a ring buffer of size records.
+        """
+        self.stop_sampler()
+        self.sampler = SequenceSampler(self.hardware, rate, size, self.lock)
+        self.sampler.start()
+
+
+    def stop_sampler(self):
+        """ Stop recording the sequence position timeline.
+
+        Returns the error that stopped sampling early, or None.
+        """
+        if self.sampler is not None:
+            return self.sampler.stop()
+
+
+    def clear_sampler(self):
+        """ Discard the recorded timeline, e.g. between acquisitions. """
+        if self.sampler is not None:
+            self.sampler.clear()
+
+
+    def get_sampler_timeline(self):
+        """ Return the timeline as a structured array of (time, index). """
+        if self.sampler is None:
+            return None
+        return self.sampler.get_timeline()
+
+
+    def get_sampler_statistics(self):
+        """ Return frame rate, jitter and dropped-frame counts. """
+        if self.sampler is None:
+            return None
+        return self.sampler.get_statistics(len(self.sequence) or None)
+
+
+    @locked
+    def start_trace(self, path):
+        """ Record the device's DLL calls to a trace file at path. """
+        self.hardware.start_trace(path)
+
+
+    @locked
+    def stop_trace(self):
+        """ Stop recording DLL calls; returns the number recorded. """
+        tracer = self.hardware.tracer
+        self.hardware.stop_trace()
+        return tracer.count if tracer else 0
+
+
+    @locked
+    def start_profile(self, kind='cprofile', methods=None):
+        """ Profile calls to methods, or all public methods, until stopped.
+
+        kind is 'cprofile' or 'tracemalloc'; methods is a method name or a
+        list of them. Methods are wrapped on this instance only while
+        profiling, so there is no overhead at other times.
+        """
+        if self.profiler is not None:
+            raise Exception('Already profiling --- call stop_profile first.')
+        if methods is None:
+            methods = [name for name in dir(type(self))
+                       if not name.startswith('_')
+                       and name not in ('start_profile', 'stop_profile')
+                       and callable(getattr(type(self), name))]
+        elif isinstance(methods, basestring):
+            methods = [methods]
+        # Check every name, dropping repeats, before wrapping any.
+        methods = list(OrderedDict.fromkeys(methods))
+        for name in methods:
+            if (name.startswith('_')
+                    or name in ('start_profile', 'stop_profile')
+                    or not callable(getattr(type(self), name, None))):
+                raise Exception('Cannot profile %s: not a method of the '
+                                'service.' % name)
+        profiler = CallProfiler(kind)
+        for name in methods:
+            setattr(self, name, profiler.wrap(getattr(self, name)))
+        self.profiler = profiler
+        self._profiled = methods
+        self.logger.info('Started %s profile of %s.' % (kind, methods))
+
+
+    @locked
+    def stop_profile(self, path=None, top=20):
+        """ Stop profiling and return the results.
+
+        See profiling.CallProfiler.finish: the results are a dict of the
+        top functions or allocation sites; with path, the full results are
+        also saved there on the SLM host, e.g. as a .prof file.
+        """
+        if self.profiler is None:
+            raise Exception('Not profiling.')
+        for name in self._profiled:
+            # Uncover the class's method.
+            del self.__dict__[name]
+        profiler, self.profiler, self._profiled = self.profiler, None, []
+        return profiler.finish(path, top)
+
+
+    def execute_batch(self, calls):
+        """ Make a list of calls atomically, in one round trip.
+
+        calls is a list of (method, args, kwargs) tuples naming methods of
+        this object; kwargs, or args and kwargs, may be omitted. All calls
+        are made under the hardware lock, so no other client's calls are
+        interleaved. Execution stops at the first call that raises; calls
+        already made are not undone.
+        Returns (results, error): results holds the return value of each
+        call made; error is None, or (index, exception) for the failed call.
+        """
+        results = []
+        with self.lock:
+            for n, call in enumerate(calls):
+                try:
+                    method = call[0]
+                    args = call[1] if len(call) > 1 else ()
+                    kwargs = call[2] if len(call) > 2 else {}
+                    if method.startswith('_'):
+                        raise AttributeError(
+                            "Method %s can not be batched." % method)
+                    if method in UNBATCHED:
+                        raise Exception(
+                            "Method %s can not be batched: it waits for "
+                            "threads that need the hardware lock, which the "
+                            "batch holds." % method)
+                    func = getattr(self, method)
+                    results.append(func(*(args or ()), **(kwargs or {})))
+                except Exception as e:
+                    self.logger.error("Batch call %d (%s) failed: %s" 
+                                      % (n, call[0], e))
+                    return results, (n, e)
+        return results, None
+
+
+    def _get_zernike_basis(self):
+        """ Return the Zernike basis for the current geometry, cached. """
+        geometry = (self.zernike_order, self.pupil_radius, 
+                    self.pixels, self.pixel_pitch)
+        if self._zernike_geometry != geometry:
+            if self.pupil_radius:
+                radius = self.pupil_radius / self.pixel_pitch
+            else:
+                radius = min(self.pixels) / 2.
+            self._zernike_basis = zernike.basis(self.zernike_order, 
+                                                self.pixels, radius)
+            self._zernike_geometry = geometry
+        return self._zernike_basis
+
+
+    def _zernike_masks(self, coefficients):
+        """ Return masks for coefficients, in waves, as 16-bit phase. """
+        masks = zernike.compose(self._get_zernike_basis(), coefficients)
+        # One wave spans the 16-bit range; wrap outside it.
+        masks16 = numpy.mod(rint(masks * 65536), 65536).astype(numpy.ushort)
+        return masks16.reshape((-1,) + self.pixels)
+
+
+    def get_zernike_modes(self):
+        """ Return the number of Zernike modes in the basis. """
+        return zernike.num_modes(self.zernike_order)
+
+
+    @locked
+    def set_zernike_order(self, order, pupil_radius=None):
+        """ Set the highest radial order and pupil radius (microns). """
+        self.zernike_order = int(order)
+        self.pupil_radius = pupil_radius
+        # Evaluate the new basis now, rather than on the next request.
+        self._get_zernike_basis()
+        if self.aberration is not None:
+            self.set_aberration(self.aberration)
+
+
+    @locked
+    def set_aberration(self, coefficients):
+        """ Set a Zernike correction to add to generated SIM patterns.
+
+        coefficients are RMS waves for Noll modes from 1 (piston); None
+        clears the correction. Applies to sequences generated from now on,
+        e.g. by a following set_sim_sequence in the same execute_batch.
+        """
+        if coefficients is None:
+            self.aberration = None
+            self._aberration16 = None
+        else:
+            self.aberration = list(coefficients)
+            self._aberration16 = self._zernike_masks(coefficients)[0]
+
+
+    def get_aberration(self):
+        return self.aberration
+
+
+    @locked
+    def set_zernike_sequence(self, wavelengths, coefficients):
+        """ Generate a sequence of Zernike masks from coefficient vectors.
+
+        coefficients is an (N, k) array of RMS waves for Noll modes from 1;
+        the N masks are composed with one matrix product, then treated as
+        patterns for set_custom_sequence.
+        """
+        self.set_custom_sequence(wavelengths, 
+                                 self._zernike_masks(coefficients))
+
+
+    @locked
+    def set_hologram_sequence(self, wavelengths, targets, iterations=20):
+        """ Generate holograms for target intensities by Gerchberg-Saxton.
+
+        targets is an intensity image, or a stack of them, of the device
+        shape, with the zero order at the centre. The whole stack is
+        iterated together. A single hologram is displayed directly; more
+        are loaded as a sequence. Returns the time taken by each
+        iteration, in seconds.
+        """
+        if self._hologram is None or self._hologram.shape != self.pixels:
+            self._hologram = GerchbergSaxton(self.pixels)
+        phases, timings = self._hologram.compute(targets, iterations)
+        # One wave spans the 16-bit range.
+        patterns16 = numpy.mod(rint(phases * (65536 / TWO_PI)), 65536)
+        self.sequence = self._make_custom_sequence(
+            wavelengths, patterns16.astype(numpy.ushort))
+        if len(self.sequence) > 1:
+            self.load_sequence()
+        else:
+            self.single_frame(0)
+        self.logger.info('%d holograms: %d iterations in %.3f s.' 
+                         % (len(phases), iterations, sum(timings)))
+        return timings
+
+
+    @locked
+    def set_true_frames(self, true_frames):
+        self.hardware.set_true_frames(true_frames)
+        self.true_frames = true_frames
+
+
+    @locked
+    def set_sequencing_framerate(self, frame_rate):
+        self.hardware.set_sequencing_framrate(frame_rate)
+        self.frame_rate = frame_rate
+
+
+    def get_frame_timing(self):
+        """ Return (frame_rate, true_frames) as last set. """
+        return (self.frame_rate, self.true_frames)
+
+
+    @locked
+    def plan_frame_rate(self, frame_rate=None, settle_time=None, apply=True):
+        """ Work out, and optionally apply, settings for a frame rate.
+
+        frame_rate is the target rate in Hz; settle_time is the time in s
+        that the liquid crystal needs to settle, and caps the rate. With
+        no target, plan for the fastest rate that settle_time allows.
+        True frames come from the DLL's ComputeTF. With apply False the
+        device is not changed, so plans can be explored safely, including
+        against a simulated device.
+        Returns a dict of the planned frame_rate, true_frames, 
+        frame_period (s), whether the rate was settle_limited, and the
+        resulting sequence_rate (Hz) for the current sequence.
+        """
+        if frame_rate is None and not settle_time:
+            raise Exception('Need a frame rate or a settle time.')
+        rate = frame_rate
+        settle_limited = False
+        if settle_time:
+            max_rate = 1. / settle_time
+            if rate is None or rate > max_rate:
+                rate = max_rate
+                settle_limited = True
+        true_frames = self.hardware.compute_true_frames(rate)
+        if true_frames < 1:
+            raise Exception('%g Hz is too fast for the board.' % rate)
+        plan = {'frame_rate': rate,
+                'true_frames': true_frames,
+                'frame_period': 1. / rate,
+                'settle_limited': settle_limited,
+                'sequence_rate': rate / len(self.sequence)
+                                 if len(self.sequence) else None}
+        if apply:
+            self.set_true_frames(true_frames)
+            self.set_sequencing_framerate(rate)
+            self.logger.info('Applied frame timing: %s' % plan)
+        return plan
+
+
+    def calibrate_backend(self, frames=None):
+        """ Select the fastest pattern kernel backend for this device.
+
+        Benchmarks frames frames, by default a full SIM sequence, with
+        each available backend; see kernels.calibrate. Returns (name,
+        timings, mismatched).
+        """
+        if frames is None:
+            frames = self.sim_num_angles * self.sim_num_phases
+        name, timings, mismatched = kernels.calibrate(self.pixels, frames)
+        for other in mismatched:
+            self.logger.warning('Backend %s output differs from numpy\'s:'
+                                ' not used.' % other)
+        self.logger.info('Kernel timings for %d frames: %s; using %s.' 
+                         % (frames, timings, name))
+        return name, timings, mismatched
+
+
+    def set_backend(self, name):
+        """ Use the named pattern kernel backend. """
+        kernels.set_backend(name)
+
+
+    def get_backend(self):
+        """ Return the backend in use and those available. """
+        return kernels.get_backend().name, kernels.get_backends()
+
+
     def get_sim_diffraction_angle(self):
         return self.sim_diffraction_angle
 
 
+    @locked
     def set_sim_diffraction_angle(self, angle):
         self.sim_diffraction_angle = float(angle)
 
 
+    @locked
     def single_frame(self, index):
         self.hardware.stop_sequence()
+        # Don't rely on the board's sequence surviving direct writes.
+        self.loaded_digest = None
         self.hardware.write_image(self.sequence[index])
 
 
+@Pyro4.expose
+class SpatialLightModulatorGroup(object):
+    """ Drives the SpatialLightModulators for several boards at once.
+
+    Calls for different boards are made concurrently, so generation and
+    upload for one board overlap with those for the others. Arguments
+    are given as dicts mapping board index to that board's arguments.
+    """
+    def __init__(self, slms):
+        self.slms = dict((slm.get_board(), slm) for slm in slms)
+        self.group = BoardGroup(self.slms)
+        # Reconnecting through any of them restores them all.
+        peers = list(slms)
+        for slm in peers:
+            slm.peers = peers
+
+
+    def get_boards(self):
+        return sorted(self.slms)
+
+
+    def set_custom_sequences(self, argsByBoard):
+        """ argsByBoard maps board to (wavelengths, patterns). """
+        return self.group.dispatch('set_custom_sequence', argsByBoard)
+
+
+    def set_sim_sequences(self, argsByBoard):
+        """ argsByBoard maps board to angle_phase_wavelength. """
+        return self.group.dispatch('set_sim_sequence',
+                                   {b: (apw,) for b, apw 
+                                              in argsByBoard.items()})
+
+
+    def run(self):
+        return self.group.dispatch('run', {b: () for b in self.slms})
+
+
+    def stop(self):
+        return self.group.dispatch('stop', {b: () for b in self.slms})
+
+
+    def reconnect(self):
+        """ Re-open the boards once, and restore every board's state. """
+        return self.slms[min(self.slms)].reconnect()
+
+
 class Server(object):
     def __init__(self):
         self.server = None
@@ -367,14 +1310,46 @@ class Server(object):
         host = config.get(CONFIG_NAME, 'ipAddress')
         port = config.getint(CONFIG_NAME, 'port')
 
-        self.server = SpatialLightModulator()
+        # Worker threads for pattern generation; defaults to one per core.
+        if config.has_option(CONFIG_NAME, 'threads'):
+            parallel.set_threads(config.getint(CONFIG_NAME, 'threads'))
+
+        # Kernel backend: by default, the fastest found by a benchmark.
+        backend = 'auto'
+        if config.has_option(CONFIG_NAME, 'backend'):
+            backend = config.get(CONFIG_NAME, 'backend')
+
+        # Optionally run against a simulated DLL with simBoards boards.
+        if (config.has_option(CONFIG_NAME, 'simulate') 
+                and config.getboolean(CONFIG_NAME, 'simulate')):
+            import bnssim
+            numBoards = 1
+            if config.has_option(CONFIG_NAME, 'simBoards'):
+                numBoards = config.getint(CONFIG_NAME, 'simBoards')
+            lib = bnssim.SimulatedLibrary(numBoards)
+        else:
+            lib = None
+
+        # One SpatialLightModulator per board: board 0 is served as pyroSLM,
+        # others as pyroSLM1, pyroSLM2 ...
+        devices = bnsdevice.open_boards(lib)
+        slms = [SpatialLightModulator(device) for device in devices]
+        if backend == 'auto':
+            slms[0].calibrate_backend()
+        else:
+            kernels.set_backend(backend)
+        self.server = slms[0]
+        objects = {slm: 'pyroSLM' + (str(n) if n else '') 
+                   for n, slm in enumerate(slms)}
+        if len(slms) > 1:
+            objects[SpatialLightModulatorGroup(slms)] = 'pyroSLMGroup'
 
         daemon = Pyro4.Daemon(port=port, host=host)
 
         # Start the daemon in a new thread.
         self.daemon_thread = threading.Thread(
             target=Pyro4.Daemon.serveSimple,
-            args = ({self.server: 'pyroSLM'},),
+            args = (objects,),
             kwargs = {'daemon': daemon, 'ns': False}
             )
         self.daemon_thread.start()
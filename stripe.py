@@ -1,5 +1,7 @@
 import numpy as np
 import os
+import parallel
+import kernels
 from numpy import rint, cos, sin, pi, meshgrid, arange
 
 from operator import itemgetter
@@ -30,18 +32,21 @@ def generate_stripe_series(patternparms):
     xindices = np.arange(512)
     yindices = np.arange(512)
     kk, ll = meshgrid(xindices, yindices)
-    sequence = []
-    for realpitch, angle, phase, waves, wavelength in patternparms:
+
+    def make_tile(n, rows):
+        realpitch, angle, phase, waves, wavelength = patternparms[n]
         pitch = realpitch / 15.0
         modulation = waves * (2**16)
         lut = LUTS[whichLUT(wavelength)]
-        pattern16 = np.ushort(
-                rint(32768. + (modulation / 2) * cos(
-                    phase + 2 * pi * (kk * cos(angle) + ll * sin(angle)) / pitch)
-                    ))
-        pattern = lut[pattern16/4]
-        sequence.append(pattern)
-    return sequence
+        pattern16 = kernels.grating(kk[rows], ll[rows], cos(angle),
+                                    sin(angle), pitch, phase,
+                                    32768., modulation / 2)
+        return kernels.lut_map(lut, pattern16)
+
+    # Frames are split into row tiles evaluated in parallel.
+    frames = parallel.render_frames(len(patternparms), kk.shape, make_tile,
+                                    dtype=LUTS[whichLUT(0)].dtype)
+    return list(frames)
 
 
 def generate_old_series(patternparms):
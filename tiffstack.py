@@ -0,0 +1,190 @@
+""" Loads stacks of 16-bit TIFF images into a single array.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Unlike BNSDevice.read_tiff, this needs neither the DLL nor an initialized
+device. Pages stored as uncompressed, contiguous, single-channel 16-bit
+data are memory-mapped and copied straight into the output; anything else
+is decoded with PIL. Pages are processed concurrently on a thread pool.
+"""
+
+import os
+import struct
+import numpy
+from multiprocessing.pool import ThreadPool
+
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+
+## TIFF tags that we need to decide whether a page can be mapped.
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+STRIP_OFFSETS = 273
+SAMPLES_PER_PIXEL = 277
+STRIP_BYTE_COUNTS = 279
+SAMPLE_FORMAT = 339
+
+## Field type: (struct format, size)
+FIELD_TYPES = {1: ('B', 1), 3: ('H', 2), 4: ('I', 4), 16: ('Q', 8)}
+
+
+class TiffPage(object):
+    """ Location and layout of one page (IFD) of a TIFF file. """
+    def __init__(self, path, index, byteorder, tags):
+        self.path = path
+        self.index = index
+        # '<' or '>'
+        self.byteorder = byteorder
+        self.width = tags.get(IMAGE_WIDTH, [0])[0]
+        self.height = tags.get(IMAGE_LENGTH, [0])[0]
+        self.bits = tags.get(BITS_PER_SAMPLE, [1])[0]
+        self.compression = tags.get(COMPRESSION, [1])[0]
+        self.samples = tags.get(SAMPLES_PER_PIXEL, [1])[0]
+        self.sample_format = tags.get(SAMPLE_FORMAT, [1])[0]
+        self.offsets = tags.get(STRIP_OFFSETS, [])
+        self.counts = tags.get(STRIP_BYTE_COUNTS, [])
+
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+
+    @property
+    def mappable(self):
+        """ Whether the pixel data is raw, contiguous, 16-bit unsigned. """
+        if (self.compression != 1 or self.bits != 16 or self.samples != 1
+                or self.sample_format != 1 or not self.offsets):
+            return False
+        for n in range(1, len(self.offsets)):
+            if self.offsets[n] != self.offsets[n-1] + self.counts[n-1]:
+                return False
+        return sum(self.counts) >= 2 * self.width * self.height
+
+
+def read_pages(path):
+    """ Return a TiffPage for each page in the TIFF file at path. """
+    pages = []
+    with open(path, 'rb') as f:
+        header = f.read(8)
+        if header[:2] == b'II':
+            byteorder = '<'
+        elif header[:2] == b'MM':
+            byteorder = '>'
+        else:
+            raise Exception("%s is not a TIFF file." % path)
+        magic, offset = struct.unpack(byteorder + 'HI', header[2:8])
+        if magic != 42:
+            raise Exception("%s is not a classic TIFF file." % path)
+        while offset:
+            f.seek(offset)
+            count, = struct.unpack(byteorder + 'H', f.read(2))
+            entries = f.read(12 * count)
+            tags = {}
+            for n in range(count):
+                entry = entries[12*n : 12*(n+1)]
+                tag, ftype, nvalues = struct.unpack(byteorder + 'HHI',
+                                                    entry[:8])
+                if ftype not in FIELD_TYPES:
+                    continue
+                fmt, size = FIELD_TYPES[ftype]
+                fmt = byteorder + str(nvalues) + fmt
+                if size * nvalues <= 4:
+                    data = entry[8 : 8 + size * nvalues]
+                else:
+                    where = f.tell()
+                    f.seek(struct.unpack(byteorder + 'I', entry[8:])[0])
+                    data = f.read(size * nvalues)
+                    f.seek(where)
+                tags[tag] = struct.unpack(fmt, data)
+            pages.append(TiffPage(path, len(pages), byteorder, tags))
+            offset, = struct.unpack(byteorder + 'I', f.read(4))
+    return pages
+
+
+def _list_files(path):
+    if isinstance(path, (list, tuple)):
+        return list(path)
+    if os.path.isdir(path):
+        return [os.path.join(path, f) for f in sorted(os.listdir(path))
+                if os.path.splitext(f)[1].lower() in TIFF_EXTENSIONS]
+    return [path]
+
+
+def _read_mapped(page, out):
+    dtype = numpy.dtype(page.byteorder + 'u2')
+    data = numpy.memmap(page.path, dtype=dtype, mode='r',
+                        offset=page.offsets[0], shape=page.shape)
+    out[...] = data
+    del data
+
+
+def _read_decoded(page, out):
+    from PIL import Image
+    image = Image.open(page.path)
+    image.seek(page.index)
+    if image.size != (out.shape[1], out.shape[0]):
+        image = image.resize((out.shape[1], out.shape[0]))
+    data = numpy.asarray(image)
+    if data.ndim == 3:
+        # Colour image: use luminance as for 8-bit greyscale.
+        data = numpy.asarray(image.convert('L'))
+    if data.dtype == numpy.uint8:
+        # Scale 8-bit to the full 16-bit range.
+        out[...] = data.astype(numpy.uint16) * 257
+    else:
+        out[...] = numpy.clip(data, 0, 65535)
+
+
+def load_stack(path, shape=None, threads=4):
+    """ Load TIFF images into one (N, height, width) uint16 array.
+
+    path may be a directory, in which case its TIFF files are read in
+    name order; a single (possibly multi-page) file; or a list of files.
+    Every page becomes one frame. If shape is given, pages of any other
+    size are resized to (height, width) = shape; otherwise all pages must
+    match the first.
+    """
+    pages = []
+    for filename in _list_files(path):
+        pages.extend(read_pages(filename))
+    if not pages:
+        raise Exception("No TIFF images found at %s." % path)
+    if shape is None:
+        shape = pages[0].shape
+        if not all(page.shape == shape for page in pages):
+            raise Exception("TIFF images at %s differ in size." % path)
+    shape = tuple(shape)
+    out = numpy.empty((len(pages),) + shape, dtype=numpy.uint16)
+
+    def load(n):
+        page = pages[n]
+        if page.mappable and page.shape == shape:
+            _read_mapped(page, out[n])
+        else:
+            _read_decoded(page, out[n])
+
+    if threads > 1 and len(pages) > 1:
+        pool = ThreadPool(min(threads, len(pages)))
+        try:
+            pool.map(load, range(len(pages)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for n in range(len(pages)):
+            load(n)
+    return out
@@ -0,0 +1,100 @@
+""" Zernike polynomial phase masks.
+
+Copyright 2014-2015 Mick Phillips (mick.phillips at gmail dot com)
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Modes are numbered by Noll's convention, starting at 1 (piston), and
+normalized to unit RMS over the pupil. Coefficient vectors start at
+Noll index 1.
+"""
+
+import numpy
+from math import factorial, sqrt
+
+
+def num_modes(order):
+    """ Number of modes up to and including radial order. """
+    return (order + 1) * (order + 2) // 2
+
+
+def noll_to_nm(j):
+    """ Return radial order n and signed azimuthal frequency m for Noll j. """
+    n = int((-1 + sqrt(8 * (j - 1) + 1)) / 2)
+    p = j - n * (n + 1) // 2
+    k = n % 2
+    m = 2 * ((p + k) // 2) - k
+    # Even j are cosine terms, odd j sine terms.
+    if m and j % 2:
+        m = -m
+    return n, m
+
+
+def radial(n, m, rho):
+    """ Evaluate the radial polynomial R_n^|m| at rho. """
+    m = abs(m)
+    result = numpy.zeros_like(rho)
+    for s in range((n - m) // 2 + 1):
+        c = ((-1) ** s * factorial(n - s)
+             / float(factorial(s) * factorial((n + m) // 2 - s)
+                     * factorial((n - m) // 2 - s)))
+        result += c * rho ** (n - 2 * s)
+    return result
+
+
+def basis(order, shape, radius, centre=None):
+    """ Return Zernike modes up to radial order as a (modes, H*W) matrix.
+
+    radius and centre define the pupil in pixels; centre defaults to the
+    middle of the array. Values outside the pupil are zero.
+    """
+    height, width = shape
+    if centre is None:
+        centre = ((height - 1) / 2., (width - 1) / 2.)
+    y, x = numpy.mgrid[0:height, 0:width].astype(numpy.float64)
+    y = (y - centre[0]) / radius
+    x = (x - centre[1]) / radius
+    rho = numpy.hypot(x, y).ravel()
+    phi = numpy.arctan2(y, x).ravel()
+    inside = rho <= 1.
+    rho, phi = rho[inside], phi[inside]
+
+    modes = numpy.zeros((num_modes(order), height * width))
+    for j in range(1, num_modes(order) + 1):
+        n, m = noll_to_nm(j)
+        values = radial(n, m, rho)
+        if m == 0:
+            values *= sqrt(n + 1)
+        elif m > 0:
+            values *= sqrt(2 * (n + 1)) * numpy.cos(m * phi)
+        else:
+            values *= sqrt(2 * (n + 1)) * numpy.sin(-m * phi)
+        modes[j - 1, inside] = values
+    return modes
+
+
+def compose(modes, coefficients):
+    """ Combine modes with one or more coefficient vectors.
+
+    coefficients is a vector, or an (N, k) array, of up to modes.shape[0]
+    coefficients each; missing higher modes are taken as zero.
+    Returns the masks as an (N, H*W) array, in the units of coefficients,
+    with one matrix product.
+    """
+    coefficients = numpy.atleast_2d(numpy.asarray(coefficients,
+                                                  dtype=numpy.float64))
+    k = coefficients.shape[1]
+    if k > modes.shape[0]:
+        raise Exception("%d coefficients given, but only %d modes."
+                        % (k, modes.shape[0]))
+    return numpy.dot(coefficients, modes[:k])